@@ -0,0 +1,497 @@
+"""
+Офлайн-бенчмарк бота: без Discord и Telegram.
+
+Вместо TelegramClient — синтетический канал на тысячи аудио с настраиваемой
+задержкой и полосой, вместо VoiceClient — «динамик», который читает пакеты
+раз в 20 мс, как настоящий. Через них гоняются настоящие _cmd_* и player_loop
+для N гильдий, а в конце печатается сводка: задержки команд, паузы между
+треками, CPU на поток, память на GuildPlayer и число запросов к Telegram.
+
+    python bench.py --guilds 20 --tracks 5000 --duration 60
+    python bench.py --json bench.json     # сохранить результат для сравнения
+
+Если в системе есть ffmpeg, треки — настоящий Ogg/Opus и играет настоящий
+FFmpegOpusAudio; иначе (или с --fake-ffmpeg) источник подменяется
+заглушкой, которая отдаёт пакеты с той же частотой.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import shutil
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+from typing import Optional
+
+import discord
+from telethon.tl.types import MessageMediaDocument
+
+WORDS = ["кино", "звезда", "ночь", "город", "любовь", "лето", "море", "dream", "night", "city",
+         "blue", "fire", "summer", "road", "rain", "ветер", "весна", "dance", "heart", "light"]
+
+bot = None   # модуль main, импортируется после настройки окружения
+
+# ────────────────────────────────────────────────────────────────────────────
+# Telegram
+# ────────────────────────────────────────────────────────────────────────────
+
+class FakeDocument:
+    def __init__(self, doc_id: int, size: int):
+        self.id = doc_id
+        self.size = size
+
+class FakeFile:
+    def __init__(self, name: str, size: int, duration: int):
+        self.name = name
+        self.size = size
+        self.ext = os.path.splitext(name)[1]
+        self.mime_type = "audio/ogg"
+        self.duration = duration
+
+class FakeMessage:
+    def __init__(self, msg_id: int, title: str, size: int, duration: int):
+        self.id = msg_id
+        self.input_chat = None
+        self.message = title
+        self.document = FakeDocument(1_000_000 + msg_id, size)
+        self.media = MessageMediaDocument(document=None)
+        self.file = FakeFile(f"track_{msg_id}.ogg", size, duration)
+
+class FakeTelegramClient:
+    """
+    Канал из n_tracks аудио. Каждый запрос ждёт latency, загрузка идёт
+    со скоростью bandwidth байт/с. Считает запросы по методам.
+    """
+
+    PAGE = 100          # сообщений за один запрос iter_messages
+    CHUNK = 128 * 1024  # как у iter_download по умолчанию
+
+    def __init__(self, n_tracks: int, sample: bytes, duration: int, latency: float, bandwidth: float):
+        self.sample = sample
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.calls: Counter = Counter()
+        size = len(sample) + 8
+        rng = random.Random(1)
+        self.messages = {
+            i: FakeMessage(i, " ".join(rng.sample(WORDS, 3)) + f" {i}", size, duration)
+            for i in range(1, n_tracks + 1)
+        }
+
+    async def _request(self, method: str):
+        self.calls[method] += 1
+        await asyncio.sleep(self.latency)
+
+    def is_connected(self) -> bool:
+        return True
+
+    async def connect(self):
+        pass
+
+    def add_event_handler(self, callback, event):
+        pass
+
+    async def get_entity(self, chan):
+        await self._request("get_entity")
+        return "bench-channel"
+
+    async def get_messages(self, entity, ids):
+        await self._request("get_messages")
+        if isinstance(ids, int):
+            return self.messages.get(ids)
+        return [self.messages.get(i) for i in ids]
+
+    async def iter_messages(self, entity, limit: Optional[int] = None, min_id: int = 0, reverse: bool = False):
+        ids = sorted((i for i in self.messages if i > min_id), reverse=not reverse)
+        if limit is not None:
+            ids = ids[:limit]
+        for n, msg_id in enumerate(ids):
+            if n % self.PAGE == 0:
+                await self._request("iter_messages")
+            yield self.messages[msg_id]
+
+    async def _iter_download(self, document, file_size: int = 0, msg_data=None):
+        # Содержимое у всех документов разное, иначе кэш схлопнет их в один файл
+        data = self.sample + document.id.to_bytes(8, "big")
+        for offset in range(0, len(data), self.CHUNK):
+            chunk = data[offset:offset + self.CHUNK]
+            await self._request("get_file")
+            await asyncio.sleep(len(chunk) / self.bandwidth)
+            yield chunk
+
+# ────────────────────────────────────────────────────────────────────────────
+# Discord
+# ────────────────────────────────────────────────────────────────────────────
+
+class FakeVoiceClient:
+    """Читает источник раз в 20 мс в своём потоке, как discord.player.AudioPlayer."""
+
+    def __init__(self, channel: "FakeVoiceChannel"):
+        self.channel = channel
+        self.guild = channel.guild
+        self.packets = 0
+        self._connected = True
+        self._thread: Optional[threading.Thread] = None
+        self._end = threading.Event()
+        self._resumed = threading.Event()
+
+    def is_connected(self) -> bool:
+        return self._connected
+
+    def is_playing(self) -> bool:
+        return self._thread is not None and not self._end.is_set() and self._resumed.is_set()
+
+    def is_paused(self) -> bool:
+        return self._thread is not None and not self._end.is_set() and not self._resumed.is_set()
+
+    def play(self, source: discord.AudioSource, *, after=None):
+        if self.is_playing():
+            raise discord.ClientException("Already playing audio.")
+        self._end = end = threading.Event()
+        self._resumed = resumed = threading.Event()
+        resumed.set()
+        self._thread = threading.Thread(target=self._run, args=(source, after, end, resumed), daemon=True)
+        self._thread.start()
+
+    def _run(self, source, after, end: threading.Event, resumed: threading.Event):
+        error = None
+        next_at = time.perf_counter()
+        try:
+            while not end.is_set():
+                if not resumed.is_set():
+                    resumed.wait()
+                    next_at = time.perf_counter()
+                    continue
+                if not source.read():
+                    break
+                self.packets += 1
+                next_at += 0.02
+                time.sleep(max(0.0, next_at - time.perf_counter()))
+        except Exception as e:
+            error = e
+        finally:
+            end.set()
+            source.cleanup()
+            if after is not None:
+                after(error)
+
+    def stop(self):
+        self._end.set()
+        self._resumed.set()
+
+    def pause(self):
+        self._resumed.clear()
+
+    def resume(self):
+        self._resumed.set()
+
+    async def move_to(self, channel):
+        self.channel = channel
+
+    async def disconnect(self, *, force: bool = False):
+        self.stop()
+        self._connected = False
+
+class FakeUser:
+    def __init__(self, bot_flag: bool):
+        self.bot = bot_flag
+
+class FakeVoiceChannel:
+    def __init__(self, guild: "FakeGuild"):
+        self.id = guild.id * 10
+        self.name = f"voice-{guild.id}"
+        self.guild = guild
+        self.members = [FakeUser(False)]
+
+    async def connect(self, *, self_deaf: bool = False):
+        return FakeVoiceClient(self)
+
+class FakeGuild:
+    def __init__(self, guild_id: int):
+        self.id = guild_id
+        self.name = f"guild-{guild_id}"
+        self.voice_channel = FakeVoiceChannel(self)
+
+class FakeVoiceState:
+    def __init__(self, channel: FakeVoiceChannel):
+        self.channel = channel
+
+class FakeMember(discord.Member):
+    # connect_to_author_channel проверяет isinstance(user, discord.Member)
+    voice = None
+    bot = False
+
+    def __init__(self, guild: FakeGuild):
+        self.voice = FakeVoiceState(guild.voice_channel)
+
+class FakeMessageRef:
+    async def edit(self, **kwargs):
+        pass
+
+class FakeResponse:
+    def __init__(self, interaction: "FakeInteraction"):
+        self.interaction = interaction
+
+    def _ack(self):
+        if self.interaction.acked_at is None:
+            self.interaction.acked_at = time.perf_counter()
+
+    async def defer(self, **kwargs):
+        self._ack()
+
+    async def send_message(self, content=None, **kwargs):
+        self._ack()
+
+class FakeFollowup:
+    async def send(self, content=None, wait: bool = False, **kwargs):
+        return FakeMessageRef()
+
+class FakeInteraction:
+    def __init__(self, guild: FakeGuild):
+        self.guild = guild
+        self.guild_id = guild.id
+        self.user = FakeMember(guild)
+        self.response = FakeResponse(self)
+        self.followup = FakeFollowup()
+        self.acked_at: Optional[float] = None
+
+# ────────────────────────────────────────────────────────────────────────────
+# Аудио
+# ────────────────────────────────────────────────────────────────────────────
+
+def make_sample(seconds: int, workdir: str) -> Optional[bytes]:
+    """Настоящий Ogg/Opus-файл нужной длины или None, если ffmpeg нет."""
+    if not shutil.which("ffmpeg"):
+        return None
+    path = os.path.join(workdir, "sample.ogg")
+    subprocess.run(
+        ["ffmpeg", "-v", "error", "-y", "-f", "lavfi", "-i", f"sine=frequency=440:duration={seconds}",
+         "-c:a", "libopus", "-b:a", "96k", path],
+        check=True,
+    )
+    with open(path, "rb") as f:
+        return f.read()
+
+class FakeOpusAudio(discord.AudioSource):
+    """
+    Замена FFmpegOpusAudio без ffmpeg: отдаёт packets пакетов, а pipe-вход
+    (GrowingFileReader) вычитывает в фоне, как это делал бы ffmpeg.
+    """
+
+    packets = 50 * 5
+
+    def __init__(self, source, *, pipe: bool = False, **kwargs):
+        self._left = self.packets
+        if pipe:
+            threading.Thread(target=self._drain, args=(source,), daemon=True).start()
+
+    @staticmethod
+    def _drain(reader):
+        while reader.read(64 * 1024):
+            pass
+
+    @classmethod
+    async def probe(cls, source, *, method=None, executable=None):
+        return "opus", 96
+
+    def is_opus(self) -> bool:
+        return True
+
+    def read(self) -> bytes:
+        if self._left <= 0:
+            return b""
+        self._left -= 1
+        return b"\xf8\xff\xfe"
+
+# ────────────────────────────────────────────────────────────────────────────
+# Сценарий
+# ────────────────────────────────────────────────────────────────────────────
+
+class Recorder:
+    def __init__(self):
+        self.ack: dict[str, list[float]] = defaultdict(list)    # до первого ответа Discord
+        self.total: dict[str, list[float]] = defaultdict(list)  # до конца обработчика
+        self.errors: Counter = Counter()
+
+    async def run(self, name: str, guild: FakeGuild, handler, *args):
+        interaction = FakeInteraction(guild)
+        started = time.perf_counter()
+        try:
+            await handler(interaction, *args)
+        except Exception as e:
+            self.errors[f"{name}: {type(e).__name__}"] += 1
+            return
+        done = time.perf_counter()
+        self.total[name].append(done - started)
+        self.ack[name].append((interaction.acked_at or done) - started)
+
+async def guild_session(rec: Recorder, guild: FakeGuild, titles: list[str], deadline: float, rate: float):
+    """Пользователь одной гильдии: /play, /queue, иногда /skip и /pause-/resume."""
+    rng = random.Random(guild.id)
+    while time.perf_counter() < deadline:
+        await asyncio.sleep(rng.expovariate(rate))
+        roll = rng.random()
+        if roll < 0.45:
+            await rec.run("play", guild, bot._cmd_play, rng.choice(titles).rsplit(" ", 1)[0])
+        elif roll < 0.75:
+            await rec.run("queue", guild, bot._cmd_queue)
+        elif roll < 0.9:
+            await rec.run("skip", guild, bot._cmd_skip)
+        else:
+            await rec.run("pause", guild, bot._cmd_pause)
+            await asyncio.sleep(0.5)
+            await rec.run("resume", guild, bot._cmd_resume)
+
+def percentiles(values: list[float]) -> str:
+    if not values:
+        return "—"
+    values = sorted(values)
+
+    def ms(q: float) -> float:
+        return values[min(len(values) - 1, int(q * len(values)))] * 1000
+
+    return f"p50 {ms(0.5):7.1f} мс  p95 {ms(0.95):7.1f} мс  max {values[-1] * 1000:7.1f} мс  (n={len(values)})"
+
+def stage_summary(stage: str, family: str = "bot_stage_seconds") -> Optional[dict]:
+    h = bot.metrics.hists.get((family, stage, None))
+    if h is None or not h.count:
+        return None
+    return {"p50": h.quantile(0.5), "p95": h.quantile(0.95), "mean": h.sum / h.count, "n": h.count}
+
+async def bench(args) -> dict:
+    guilds = [FakeGuild(100 + i) for i in range(args.guilds)]
+    titles = [m.message for m in bot.tele_client.messages.values()]
+    rec = Recorder()
+
+    # Каталог строится как при первом запуске
+    started = time.perf_counter()
+    await bot.ensure_catalog()
+    catalog_build = time.perf_counter() - started
+
+    # Память: плееры с длинной /shuffleall-очередью, под tracemalloc только эта фаза
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    for guild in guilds:
+        await rec.run("shuffleall", guild, bot._cmd_shuffle_all, args.shuffle)
+    per_player = (tracemalloc.get_traced_memory()[0] - base) / len(guilds)
+    tracemalloc.stop()
+
+    cpu_started = time.process_time()
+    children_started = resource.getrusage(resource.RUSAGE_CHILDREN)
+    wall_started = time.perf_counter()
+    deadline = wall_started + args.duration
+    await asyncio.gather(*(guild_session(rec, g, titles, deadline, args.rate) for g in guilds))
+    wall = time.perf_counter() - wall_started
+    cpu = time.process_time() - cpu_started
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    children_cpu = (children.ru_utime - children_started.ru_utime) + (children.ru_stime - children_started.ru_stime)
+
+    packets = sum(p.voice.packets for p in bot.players.values() if p.voice)
+    streams = max(packets * 0.02 / wall, 1e-9)   # в среднем одновременно игравших потоков
+
+    for player in bot.players.values():
+        player.queue.clear()
+        player.now_playing = None
+        bot.refresh_prefetch(player)
+        if player.voice:
+            player.voice.stop()
+        player.task.cancel()
+    await asyncio.sleep(0.1)
+
+    return {
+        "guilds": args.guilds,
+        "tracks": len(titles),
+        "duration_s": wall,
+        "catalog_build_s": catalog_build,
+        "commands": {name: {"ack": sorted(rec.ack[name]), "total": sorted(rec.total[name])} for name in rec.total},
+        "errors": dict(rec.errors),
+        "stages": {stage: stage_summary(stage) for stage in
+                   ("catalog_lookup", "download", "ffmpeg_spawn", "first_packet", "track_gap")},
+        "download_bytes_per_s": stage_summary("download", "bot_download_bytes_per_second"),
+        "avg_streams": streams,
+        "cpu_per_stream": cpu / wall / streams,
+        "ffmpeg_cpu_per_stream": children_cpu / wall / streams,
+        "bytes_per_player": per_player,
+        "telegram_calls": dict(bot.tele_client.calls),
+        "telegram_gate_calls": bot.tg_gate.calls,
+        "telegram_gate_steps": bot.tg_gate.steps,
+    }
+
+def report(result: dict):
+    print(f"\nГильдий: {result['guilds']}, треков в канале: {result['tracks']}, "
+          f"прогон: {result['duration_s']:.1f} с, каталог построен за {result['catalog_build_s']:.2f} с")
+    print("\nКоманды (до ответа Discord / до конца обработчика):")
+    for name, r in sorted(result["commands"].items()):
+        print(f"  /{name:<10} ответ  {percentiles(r['ack'])}")
+        print(f"  {'':<11} всего  {percentiles(r['total'])}")
+    if result["errors"]:
+        print("  ошибки:", ", ".join(f"{k} ×{v}" for k, v in result["errors"].items()))
+    print("\nЭтапы (по корзинам гистограмм):")
+    for stage, s in result["stages"].items():
+        if s:
+            print(f"  {stage:<15} p50 ≤ {s['p50'] * 1000:7.1f} мс  p95 ≤ {s['p95'] * 1000:7.1f} мс  "
+                  f"среднее {s['mean'] * 1000:7.1f} мс  (n={s['n']})")
+    if result["download_bytes_per_s"]:
+        print(f"  скорость загрузки: среднее {result['download_bytes_per_s']['mean'] / 2**20:.2f} MB/s")
+    print(f"\nВ среднем играло потоков: {result['avg_streams']:.1f}")
+    print(f"CPU на поток: бот {result['cpu_per_stream'] * 100:.2f}% ядра, "
+          f"ffmpeg {result['ffmpeg_cpu_per_stream'] * 100:.2f}% ядра")
+    print(f"Память на GuildPlayer (с очередью /shuffleall): {result['bytes_per_player'] / 1024:.1f} KB")
+    calls = ", ".join(f"{k}: {v}" for k, v in sorted(result["telegram_calls"].items()))
+    print(f"Запросы к Telegram: {calls} (через tg_gate: {result['telegram_gate_calls']} запросов, "
+          f"{result['telegram_gate_steps']} шагов iter_*)")
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк бота с поддельными Discord и Telegram")
+    parser.add_argument("--guilds", type=int, default=10, help="сколько гильдий играет одновременно")
+    parser.add_argument("--tracks", type=int, default=3000, help="сколько аудио в синтетическом канале")
+    parser.add_argument("--duration", type=float, default=30, help="длительность прогона, с")
+    parser.add_argument("--rate", type=float, default=0.5, help="команд в секунду на гильдию")
+    parser.add_argument("--shuffle", type=int, default=500, help="лимит /shuffleall в начале")
+    parser.add_argument("--track-seconds", type=int, default=5, help="длина каждого трека")
+    parser.add_argument("--latency", type=float, default=0.05, help="задержка запроса к Telegram, с")
+    parser.add_argument("--bandwidth", type=float, default=4.0, help="скорость загрузки, MB/s")
+    parser.add_argument("--fake-ffmpeg", action="store_true", help="не запускать ffmpeg, даже если он есть")
+    parser.add_argument("--json", help="записать результат в этот файл")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_")
+    os.environ.update({
+        "DISCORD_TOKEN": "bench", "TELEGRAM_API_ID": "1", "TELEGRAM_API_HASH": "bench",
+        "TELEGRAM_CHANNEL": "bench", "TEMP_DIR": workdir, "METRICS": "1", "METRICS_PORT": "0",
+        "TELEGRAM_SESSION_NAME": os.path.join(workdir, "bench"),
+    })
+    global bot
+    import main as bot_module
+    bot = bot_module
+
+    sample = None if args.fake_ffmpeg else make_sample(args.track_seconds, workdir)
+    if sample is None:
+        print("[bench] ffmpeg не используется — источник звука поддельный")
+        FakeOpusAudio.packets = 50 * args.track_seconds
+        discord.FFmpegOpusAudio = FakeOpusAudio
+        sample = os.urandom(64 * 1024)
+    bot.tele_client = FakeTelegramClient(args.tracks, sample, args.track_seconds,
+                                         args.latency, args.bandwidth * 2**20)
+    try:
+        result = asyncio.run(bench(args))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    report(result)
+    if args.json:
+        for r in result["commands"].values():
+            r["ack"] = statistics.median(r["ack"]) if r["ack"] else None
+            r["total"] = statistics.median(r["total"]) if r["total"] else None
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
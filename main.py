@@ -1,16 +1,35 @@
 import asyncio
+import bisect
+import hashlib
+import heapq
+import itertools
+import json
+import multiprocessing
 import os
 import random
 import re
-from dataclasses import dataclass, field
-from typing import Deque, Optional
-from collections import deque
+import signal
+import sqlite3
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field, replace
+from enum import Enum
+from typing import AsyncIterator, Deque, Iterable, Optional
+from array import array
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from urllib.parse import parse_qs, urlsplit
 
 import discord
 from discord import app_commands
 from discord.ext import commands
 
-from telethon import TelegramClient
+from telethon import TelegramClient, errors, events, utils
+from telethon.client.downloads import _CdnRedirect as TelethonCdnRedirect
+from telethon.tl.functions.upload import GetFileRequest
+from telethon.tl.types.upload import FileCdnRedirect
 from telethon.tl.types import MessageMediaDocument
 from dotenv import load_dotenv
 from yt_dlp import YoutubeDL
@@ -33,6 +52,36 @@ if not all([DISCORD_TOKEN, TELEGRAM_API_ID, TELEGRAM_API_HASH, TELEGRAM_CHANNEL]
 
 os.makedirs(TEMP_DIR, exist_ok=True)
 
+CATALOG_PATH = os.getenv("CATALOG_PATH", os.path.join(TEMP_DIR, "catalog.sqlite3"))
+CACHE_INDEX_PATH = os.path.join(TEMP_DIR, "cache_index.json")
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_MB", "2048")) * 1024 * 1024
+CACHE_INDEX_FLUSH_DELAY = 30          # сек: last_used из попаданий в кэш пишется в индекс пачкой
+PREFETCH_AHEAD = int(os.getenv("PREFETCH_AHEAD", "2"))            # сколько треков очереди качать заранее
+PREFETCH_CONCURRENCY = int(os.getenv("PREFETCH_CONCURRENCY", "3"))  # одновременных фоновых загрузок
+SHUFFLE_BATCH = 50                    # /shuffleall начинает играть после первой такой пачки
+STREAM_START_BYTES = int(os.getenv("STREAM_START_KB", "384")) * 1024  # сколько скачать до старта игры
+PARALLEL_DOWNLOAD_MIN_BYTES = int(os.getenv("PARALLEL_DOWNLOAD_MIN_MB", "8")) * 1024 * 1024
+PARALLEL_DOWNLOAD_CONNECTIONS = int(os.getenv("PARALLEL_DOWNLOAD_CONNECTIONS", "4"))
+RESUME_MAX_AGE = 24 * 3600            # сколько хранить недокачанное для продолжения
+TG_MAX_CONCURRENT_CALLS = int(os.getenv("TG_MAX_CONCURRENT_CALLS", "8"))  # одновременных запросов к Telegram
+OPUS_BITRATE = int(os.getenv("OPUS_BITRATE", "128"))              # kbit/s, если всё-таки кодируем
+OPUS_TRANSCODE = os.getenv("OPUS_TRANSCODE", "0") == "1"          # перекодировать кэш в .opus в фоне
+METRICS_ENABLED = os.getenv("METRICS", "0") == "1"                # гистограммы задержек по этапам
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))            # /metrics на 127.0.0.1; 0 — без HTTP
+SHARD_WORKERS = int(os.getenv("SHARD_WORKERS", "0"))   # процессов с шардами Discord; 0 — всё в одном процессе
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "0")) or SHARD_WORKERS   # всего шардов на все процессы
+COORDINATOR_SOCKET = os.path.join(TEMP_DIR, "coordinator.sock")
+SHARD_PIN_INTERVAL = 5                # сек: воркер сообщает координатору, какие файлы кэша у него в деле
+PLAYER_STATE_PATH = os.path.join(TEMP_DIR, "players.json")      # очереди гильдий для тёплого рестарта
+PLAYER_STATE_INTERVAL = 15            # сек между снимками (на случай падения, а не штатной остановки)
+PLAYER_STATE_MAX_AGE = int(os.getenv("PLAYER_STATE_MAX_AGE", "900"))  # снимок старше — не восстанавливаем
+COMMANDS_HASH_PATH = os.path.join(TEMP_DIR, "commands.sha256")  # схема команд при последнем tree.sync
+IDLE_PAUSE_AFTER = int(os.getenv("IDLE_PAUSE_AFTER", "30"))            # сек без слушателей до паузы
+IDLE_DISCONNECT_AFTER = int(os.getenv("IDLE_DISCONNECT_AFTER", "300"))  # сек простоя до выхода из канала
+IDLE_EVICT_AFTER = int(os.getenv("IDLE_EVICT_AFTER", "1800"))          # сек после выхода до удаления плеера
+if SHARD_WORKERS and SHARD_COUNT < SHARD_WORKERS:
+    raise RuntimeError("SHARD_COUNT должен быть не меньше SHARD_WORKERS")
+
 YDL_OPTS = {
     "format": "bestaudio/best",
     "quiet": True,
@@ -41,10 +90,18 @@ YDL_OPTS = {
     "default_search": "ytsearch",
     "geo_bypass": True,
 }
-YOUTUBE_URL_RE = re.compile(r"(https?://)?(www\.)?(youtube\.com|youtu\.be)/", re.I)
+YOUTUBE_URL_RE = re.compile(r"(https?://)?(www\.|m\.|music\.)?(youtube\.com|youtu\.be)/", re.I)
+YTDLP_PLAYLIST_MAX = int(os.getenv("YTDLP_PLAYLIST_MAX", "500"))
 YTDLP_COOKIES = os.getenv("YTDLP_COOKIES")
 if YTDLP_COOKIES and os.path.exists(YTDLP_COOKIES):
     YDL_OPTS["cookiefile"] = YTDLP_COOKIES
+YTDLP_WORKERS = int(os.getenv("YTDLP_WORKERS", "2"))        # процессов с прогретым yt-dlp
+YTDLP_CACHE_TTL = int(os.getenv("YTDLP_CACHE_TTL", "3600"))  # если в URL нет expire=
+YTDLP_CACHE_MAX = 1024
+YTDLP_EXPIRY_MARGIN = 600             # URL, которому жить меньше, считаем протухшим
+# Плейлисты — только список id/названий, без разбора каждого видео
+YDL_FLAT_OPTS = {**YDL_OPTS, "noplaylist": False, "extract_flat": "in_playlist",
+                 "playlistend": YTDLP_PLAYLIST_MAX}
 
 # ────────────────────────────────────────────────────────────────────────────
 # Discord bot
@@ -52,25 +109,213 @@ if YTDLP_COOKIES and os.path.exists(YTDLP_COOKIES):
 
 intents = discord.Intents.default()
 intents.message_content = True
-bot = commands.Bot(command_prefix="!", intents=intents)
+if SHARD_WORKERS:
+    # Какие шарды достанутся процессу, решает run_sharded() уже после fork
+    bot = commands.AutoShardedBot(command_prefix="!", intents=intents, shard_count=SHARD_COUNT)
+else:
+    bot = commands.Bot(command_prefix="!", intents=intents)
 tree = bot.tree
+process_role = "single"   # single | coordinator | worker (см. run_sharded)
 
 # ────────────────────────────────────────────────────────────────────────────
 # Telethon client
 # ────────────────────────────────────────────────────────────────────────────
 
-tele_client = TelegramClient(TELEGRAM_SESSION_NAME, TELEGRAM_API_ID, TELEGRAM_API_HASH)
+# FloodWait не глотаем внутри Telethon: его ловит tg_gate и тормозит сразу всех
+tele_client = TelegramClient(TELEGRAM_SESSION_NAME, TELEGRAM_API_ID, TELEGRAM_API_HASH,
+                             flood_sleep_threshold=0)
+
+# ────────────────────────────────────────────────────────────────────────────
+# Метрики
+# ────────────────────────────────────────────────────────────────────────────
+
+STAGE_SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+THROUGHPUT_BUCKETS = tuple(mb * 2**20 for mb in (0.25, 0.5, 1, 2, 4, 8, 16, 32, 64))
+
+METRIC_FAMILIES = {
+    # имя: (описание, границы корзин)
+    "bot_stage_seconds": ("Длительность этапов подготовки и воспроизведения", STAGE_SECONDS_BUCKETS),
+    "bot_download_bytes_per_second": ("Скорость загрузки файлов из Telegram", THROUGHPUT_BUCKETS),
+}
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)   # последняя — +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Верхняя граница корзины, в которую попадает квантиль q (грубо, но без хранения значений)."""
+        rank, seen = q * self.count, 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+class Metrics:
+    """
+    Гистограммы по этапам: общие и по гильдиям. Пишут в них и event loop,
+    и аудио-потоки discord, отсюда блокировка. Выключенные метрики —
+    одна проверка флага на вызов.
+    """
+
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        # (семейство, этап, guild_id или None для общего) -> Histogram
+        self.hists: dict[tuple[str, str, Optional[int]], Histogram] = {}
+
+    def observe(self, stage: str, value: float, guild_id: Optional[int] = None,
+                family: str = "bot_stage_seconds"):
+        if not self.enabled:
+            return
+        with self._lock:
+            for key in ((family, stage, None), (family, stage, guild_id)):
+                h = self.hists.get(key)
+                if h is None:
+                    h = self.hists[key] = Histogram(METRIC_FAMILIES[family][1])
+                h.observe(value)
+                if guild_id is None:
+                    break
+
+    def forget_guild(self, guild_id: int):
+        """Гильдию выселили — её гистограммы больше не нужны (общие остаются)."""
+        with self._lock:
+            for key in [k for k in self.hists if k[2] == guild_id]:
+                del self.hists[key]
+
+    def timer(self, stage: str, guild_id: Optional[int] = None):
+        """with metrics.timer("этап"): ... — замеряет блок, если он не упал."""
+        return _StageTimer(self, stage, guild_id) if self.enabled else _NO_TIMER
+
+    def render(self) -> str:
+        """Текстовый формат Prometheus."""
+        lines = []
+        with self._lock:
+            items = sorted(self.hists.items(), key=lambda kv: (kv[0][0], kv[0][1], kv[0][2] or 0))
+            for family, (help_text, _) in METRIC_FAMILIES.items():
+                lines.append(f"# HELP {family} {help_text}")
+                lines.append(f"# TYPE {family} histogram")
+                for (fam, stage, guild_id), h in items:
+                    if fam != family:
+                        continue
+                    labels = f'stage="{stage}",guild="{guild_id if guild_id is not None else "all"}"'
+                    cumulative = 0
+                    for bound, n in zip(h.buckets, h.counts):
+                        cumulative += n
+                        lines.append(f'{family}_bucket{{{labels},le="{bound:g}"}} {cumulative}')
+                    lines.append(f'{family}_bucket{{{labels},le="+Inf"}} {h.count}')
+                    lines.append(f"{family}_sum{{{labels}}} {h.sum:.6f}")
+                    lines.append(f"{family}_count{{{labels}}} {h.count}")
+        lines.append("# HELP bot_telegram_calls_total Запросов к Telegram через tg_gate")
+        lines.append("# TYPE bot_telegram_calls_total counter")
+        lines.append(f"bot_telegram_calls_total {tg_gate.calls}")
+        lines.append("# HELP bot_guild_players Гильдий с плеером")
+        lines.append("# TYPE bot_guild_players gauge")
+        lines.append(f"bot_guild_players {len(players)}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self, guild_id: Optional[int]) -> list[str]:
+        """Строки для /stats: p50/p95 и число замеров по каждому этапу."""
+        out = []
+        with self._lock:
+            for (family, stage, gid), h in sorted(self.hists.items(), key=lambda kv: kv[0][:2]):
+                if gid != guild_id or not h.count:
+                    continue
+                p50, p95, avg = (_format_metric(family, v)
+                                 for v in (h.quantile(0.5), h.quantile(0.95), h.sum / h.count))
+                out.append(f"`{stage}`: p50 ≤ {p50}, p95 ≤ {p95}, среднее {avg} (n={h.count})")
+        return out
+
+def _format_metric(family: str, value: float) -> str:
+    if family == "bot_download_bytes_per_second":
+        return f"{value / 2**20:.3g} MB/s"
+    return f"{value * 1000:.3g} мс" if value < 1 else f"{value:.3g} с"
+
+class _StageTimer:
+    __slots__ = ("metrics", "stage", "guild_id", "started")
+
+    def __init__(self, metrics: Metrics, stage: str, guild_id: Optional[int]):
+        self.metrics, self.stage, self.guild_id = metrics, stage, guild_id
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.metrics.observe(self.stage, time.perf_counter() - self.started, self.guild_id)
+        return False
+
+class _NoTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+_NO_TIMER = _NoTimer()
+
+metrics = Metrics(METRICS_ENABLED)
+
+async def _serve_metrics(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b"\r\n", b"\n", b""):
+            pass   # заголовки не нужны
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            status, body = "200 OK", metrics.render().encode()
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def start_metrics_server():
+    """HTTP /metrics только на localhost — наружу его отдаёт сборщик метрик."""
+    if not metrics.enabled or not METRICS_PORT:
+        return
+    await asyncio.start_server(_serve_metrics, "127.0.0.1", METRICS_PORT)
+    print(f"[metrics] http://127.0.0.1:{METRICS_PORT}/metrics")
 
 # ────────────────────────────────────────────────────────────────────────────
 # Модель данных
 # ────────────────────────────────────────────────────────────────────────────
 
-@dataclass
+@dataclass(slots=True)   # в очередях /shuffleall их тысячи на гильдию
 class Track:
     title: str
     filepath: Optional[str] = None        # локальный файл (TG)
     source_msg_id: Optional[int] = None   # id сообщения TG
     stream_url: Optional[str] = None      # прямой поток (YouTube)
+    page_url: Optional[str] = None        # страница YouTube: прямой URL берётся перед самой игрой
+    codec: Optional[str] = None           # аудиокодек потока, если известен (opus → без перекодирования)
+    start_at: float = 0.0                 # с какой секунды начать (продолжение после рестарта)
+    download: Optional["TgDownload"] = field(default=None, repr=False, compare=False)  # идущая загрузка (TG)
+
+class PlayerState(Enum):
+    IDLE = "idle"                # ничего не играет
+    RESOLVING = "resolving"      # готовим источник следующего трека
+    PLAYING = "playing"
+    PAUSED = "paused"
 
 @dataclass
 class GuildPlayer:
@@ -79,12 +324,975 @@ class GuildPlayer:
     now_playing: Optional[Track] = None
     play_lock: asyncio.Lock = field(default_factory=asyncio.Lock)
     loop_current: bool = False            # зацикливать текущий трек
+    prefetch: dict[int, asyncio.Task] = field(default_factory=dict)  # msg_id -> фоновая загрузка
+    state: PlayerState = PlayerState.IDLE
+    wake: asyncio.Event = field(default_factory=asyncio.Event)       # трек кончился / очередь изменилась
+    task: Optional[asyncio.Task] = None   # player_loop этой гильдии
+    queue_epoch: int = 0                  # растёт на /stop — фоновые добавления в очередь прекращаются
+    chain: Optional["GaplessSource"] = None            # то, что сейчас отдано voice.play
+    preload_for: Optional[Track] = None                # какой трек готовим следующим
+    preload_task: Optional[asyncio.Task] = None
+    preloaded: Optional[tuple] = None     # (трек очереди, подготовленный трек, запущенный источник)
+    preload_lock: threading.Lock = field(default_factory=threading.Lock)  # preloaded забирает аудио-поток
+    guild_id: Optional[int] = None
+    audio_gap_from: Optional[float] = None   # когда замолчал предыдущий трек (для метрики track_gap)
+    idle_reason: Optional[str] = None     # почему гильдия простаивает (см. idle_reason())
+    idle_task: Optional[asyncio.Task] = None   # таймеры паузы/выхода/выселения
+    auto_paused: bool = False             # на паузе из-за пустого канала, а не по /pause
 
 players: dict[int, GuildPlayer] = {}
 
+PICK_BY_ID_RE = re.compile(r"^id:\s*(\d+)$", re.I)   # /play id:123 — конкретное сообщение канала
+
 SUPPORTED_AUDIO_MIME_PREFIXES = ("audio/",)
 SUPPORTED_EXTS = {".mp3", ".m4a", ".ogg", ".flac", ".wav"}
 
+@dataclass
+class CatalogEntry:
+    msg_id: int
+    title: str
+    file_name: str
+    mime: str = ""
+    size: int = 0
+    duration: Optional[int] = None
+    document_id: Optional[int] = None
+
+def tg_audio_entry(msg) -> Optional[CatalogEntry]:
+    """Запись каталога для аудио-сообщения TG или None, если это не аудио."""
+    if not isinstance(msg.media, MessageMediaDocument) or not msg.file:
+        return None
+    mime = getattr(msg.file, "mime_type", "") or ""
+    name = msg.file.name or f"audio_{msg.id}"
+    ext = os.path.splitext(name)[1].lower()
+    if not (mime.startswith(SUPPORTED_AUDIO_MIME_PREFIXES) or ext in SUPPORTED_EXTS):
+        return None
+    title = (msg.message or name).strip()[:200] if msg.message else name
+    return CatalogEntry(
+        msg_id=msg.id, title=title, file_name=name, mime=mime,
+        size=msg.file.size or 0, duration=msg.file.duration,
+        document_id=msg.document.id if msg.document else None,
+    )
+
+# ────────────────────────────────────────────────────────────────────────────
+# Нечёткий поиск по названиям
+# ────────────────────────────────────────────────────────────────────────────
+
+# Кириллица → латиница: "кино" и "kino" ищутся одинаково
+_TRANSLIT = str.maketrans({
+    "а": "a", "б": "b", "в": "v", "г": "g", "д": "d", "е": "e", "ё": "e", "ж": "zh",
+    "з": "z", "и": "i", "й": "i", "к": "k", "л": "l", "м": "m", "н": "n", "о": "o",
+    "п": "p", "р": "r", "с": "s", "т": "t", "у": "u", "ф": "f", "х": "h", "ц": "ts",
+    "ч": "ch", "ш": "sh", "щ": "sch", "ъ": "", "ы": "y", "ь": "", "э": "e", "ю": "yu",
+    "я": "ya", "і": "i", "ї": "i", "є": "e", "ґ": "g",
+})
+_NON_WORD_RE = re.compile(r"[\W_]+")
+
+def normalize_title(text: str) -> str:
+    return " ".join(_NON_WORD_RE.sub(" ", text.casefold().translate(_TRANSLIT)).split())
+
+def _trigrams(norm: str) -> set[str]:
+    tris = set()
+    for word in norm.split():
+        padded = f"  {word} "
+        tris.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return tris
+
+class TitleIndex:
+    """
+    Триграммный индекс по нормализованным названиям и именам файлов.
+    Кандидаты — по числу общих триграмм, дальше небольшая доранжировка.
+    """
+
+    MIN_SCORE = 0.35
+
+    def __init__(self):
+        self.rebuild([])
+
+    def rebuild(self, rows: Iterable[tuple[int, str, str]]):
+        self.msg_ids = array("q")
+        self.titles: list[str] = []
+        self.texts: list[str] = []
+        self.by_msg_id: dict[int, int] = {}
+        self.postings: dict[str, array] = defaultdict(lambda: array("I"))
+        self.dead: set[int] = set()
+        for msg_id, title, norm in rows:
+            self._add(msg_id, title, norm)
+
+    def _add(self, msg_id: int, title: str, norm: str):
+        old = self.by_msg_id.get(msg_id)
+        if old is not None:
+            self.dead.add(old)
+        doc = len(self.titles)
+        self.msg_ids.append(msg_id)
+        self.titles.append(title)
+        self.texts.append(norm)
+        self.by_msg_id[msg_id] = doc
+        for tri in _trigrams(norm):
+            self.postings[tri].append(doc)
+
+    def add(self, rows: Iterable[tuple[int, str, str]]):
+        for msg_id, title, norm in rows:
+            self._add(msg_id, title, norm)
+        self._maybe_compact()
+
+    def remove(self, msg_ids: Iterable[int]):
+        for msg_id in msg_ids:
+            doc = self.by_msg_id.pop(msg_id, None)
+            if doc is not None:
+                self.dead.add(doc)
+        self._maybe_compact()
+
+    def _maybe_compact(self):
+        if len(self.dead) > 1000 and len(self.dead) > len(self.titles) // 4:
+            # Слишком много мёртвых документов — пересобираем без них
+            live = [(self.msg_ids[d], self.titles[d], self.texts[d]) for d in self.by_msg_id.values()]
+            self.rebuild(sorted(live))
+
+    def title(self, msg_id: int) -> Optional[str]:
+        doc = self.by_msg_id.get(msg_id)
+        return self.titles[doc] if doc is not None else None
+
+    def search(self, query: str, limit: int) -> list[tuple[int, str]]:
+        """Лучшие (msg_id, title) для запроса, с опечатками и в любой раскладке алфавита."""
+        norm = normalize_title(query)
+        q_tris = _trigrams(norm)
+        if not q_tris:
+            return []
+        counts: dict[int, int] = defaultdict(int)
+        for tri in q_tris:
+            for doc in self.postings.get(tri, ()):
+                counts[doc] += 1
+        # Доранжировать дорого — берём limit * 8 лучших по общим триграммам, но
+        # вместе со всеми, кто делит с ними последнее место: при равенстве
+        # (много вариантов одного названия) иначе решал бы порядок добавления
+        live = [(doc, shared) for doc, shared in counts.items() if doc not in self.dead]
+        if len(live) > limit * 8:
+            cutoff = heapq.nlargest(limit * 8, (shared for _, shared in live))[-1]
+            live = [(doc, shared) for doc, shared in live if shared >= cutoff]
+        words = norm.split()
+        scored = []
+        for doc, shared in live:
+            text = self.texts[doc]
+            score = shared / len(q_tris)
+            if all(w in text for w in words):
+                score += 0.5
+                if text.startswith(norm):
+                    score += 0.2
+            if score >= self.MIN_SCORE:
+                scored.append((score, -len(text), self.msg_ids[doc], doc))
+        scored.sort(reverse=True)
+        return [(self.msg_ids[d], self.titles[d]) for *_, d in scored[:limit]]
+
+# ────────────────────────────────────────────────────────────────────────────
+# Каталог Telegram-канала (SQLite)
+# ────────────────────────────────────────────────────────────────────────────
+
+class TrackCatalog:
+    """
+    Локальная копия списка аудио из TELEGRAM_CHANNEL.
+    Строится один раз, дальше догоняется по min_id и живым событиям канала.
+    """
+
+    _COLUMNS = "msg_id, title, file_name, mime, size, duration, document_id"
+
+    def __init__(self, path: str, channel: str):
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS tracks (
+                msg_id      INTEGER PRIMARY KEY,
+                title       TEXT NOT NULL,
+                file_name   TEXT NOT NULL,
+                mime        TEXT,
+                size        INTEGER,
+                duration    INTEGER,
+                document_id INTEGER,
+                search_key  TEXT NOT NULL
+            );
+        """)
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'channel'").fetchone()
+        if row is None or row[0] != channel:
+            # Сменился канал — старый каталог нам ни к чему
+            with self.db:
+                self.db.execute("DELETE FROM tracks")
+                self.db.execute("DELETE FROM meta WHERE key = 'synced_id'")
+                self.db.execute("INSERT OR REPLACE INTO meta VALUES ('channel', ?)", (channel,))
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'search_key'").fetchone()
+        if row is None or row[0] != self.SEARCH_KEY_VERSION:
+            rows = self.db.execute("SELECT msg_id, title, file_name FROM tracks").fetchall()
+            with self.db:
+                self.db.executemany("UPDATE tracks SET search_key = ? WHERE msg_id = ?",
+                                    [(self._search_key(t, f), i) for i, t, f in rows])
+                self.db.execute("INSERT OR REPLACE INTO meta VALUES ('search_key', ?)",
+                                (self.SEARCH_KEY_VERSION,))
+        self.index = TitleIndex()
+        self.index.rebuild(self.db.execute("SELECT msg_id, title, search_key FROM tracks"))
+        self._indexed_max = self.max_id()
+        self._data_version = self.db.execute("PRAGMA data_version").fetchone()[0]
+
+    SEARCH_KEY_VERSION = "2"
+
+    def refresh(self):
+        """
+        Подхватывает в индекс то, что записал в базу другой процесс (режим шардов).
+        Свои записи data_version не меняют, так что в одиночном режиме это один
+        PRAGMA. Новые сообщения добавляются, после удалений индекс пересобирается;
+        правка названия старого трека видна после следующей пересборки.
+        """
+        version = self.db.execute("PRAGMA data_version").fetchone()[0]
+        if version == self._data_version:
+            return
+        self._data_version = version
+        self.index.add(self.db.execute(
+            "SELECT msg_id, title, search_key FROM tracks WHERE msg_id > ?", (self._indexed_max,)))
+        self._indexed_max = self.max_id()
+        if len(self.index.by_msg_id) != self.count():
+            self.index.rebuild(self.db.execute("SELECT msg_id, title, search_key FROM tracks"))
+
+    @staticmethod
+    def _search_key(title: str, file_name: str) -> str:
+        name = os.path.splitext(file_name)[0]
+        return normalize_title(title if normalize_title(name) in normalize_title(title)
+                               else f"{title} {name}")
+
+    def upsert(self, entries: Iterable[CatalogEntry], synced_to: Optional[int] = None):
+        """
+        synced_to — докуда дошёл проход по каналу (в той же транзакции, что и записи).
+        Живые сообщения его не двигают: они приходят вперёд прохода.
+        """
+        rows = [
+            (e.msg_id, e.title, e.file_name, e.mime, e.size, e.duration, e.document_id,
+             self._search_key(e.title, e.file_name))
+            for e in entries
+        ]
+        if rows or synced_to is not None:
+            with self.db:
+                self.db.executemany(
+                    f"INSERT OR REPLACE INTO tracks ({self._COLUMNS}, search_key) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                if synced_to is not None:
+                    self.db.execute("INSERT OR REPLACE INTO meta VALUES ('synced_id', ?)", (str(synced_to),))
+        if rows:
+            self.index.add((r[0], r[1], r[-1]) for r in rows)
+            self._indexed_max = max(self._indexed_max, max(r[0] for r in rows))
+
+    def delete(self, msg_ids: Iterable[int]):
+        msg_ids = list(msg_ids)
+        with self.db:
+            self.db.executemany("DELETE FROM tracks WHERE msg_id = ?", [(i,) for i in msg_ids])
+        self.index.remove(msg_ids)
+
+    def synced_id(self) -> int:
+        """До какого msg_id канал пройден без пропусков (0 — ни разу или каталог без отметки)."""
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'synced_id'").fetchone()
+        return int(row[0]) if row else 0
+
+    def max_id(self) -> int:
+        return self.db.execute("SELECT COALESCE(MAX(msg_id), 0) FROM tracks").fetchone()[0]
+
+    def count(self) -> int:
+        return self.db.execute("SELECT COUNT(*) FROM tracks").fetchone()[0]
+
+    def get(self, msg_id: int) -> Optional[CatalogEntry]:
+        row = self.db.execute(
+            f"SELECT {self._COLUMNS} FROM tracks WHERE msg_id = ?", (msg_id,)).fetchone()
+        return CatalogEntry(*row) if row else None
+
+    def latest(self, limit: int) -> list[CatalogEntry]:
+        rows = self.db.execute(
+            f"SELECT {self._COLUMNS} FROM tracks ORDER BY msg_id DESC LIMIT ?", (limit,))
+        return [CatalogEntry(*r) for r in rows]
+
+    def latest_ids(self, limit: int) -> list[int]:
+        rows = self.db.execute("SELECT msg_id FROM tracks ORDER BY msg_id DESC LIMIT ?", (limit,))
+        return [r[0] for r in rows]
+
+    def titles(self, msg_ids: list[int]) -> list[tuple[int, str]]:
+        """
+        Компактные (msg_id, title) в порядке msg_ids. Строки названий берутся
+        из индекса — очереди всех гильдий ссылаются на одни и те же объекты.
+        """
+        titles = [(i, self.index.title(i)) for i in msg_ids]
+        if all(t is not None for _, t in titles):
+            return titles
+        rows = dict(self.db.execute(
+            f"SELECT msg_id, title FROM tracks WHERE msg_id IN ({','.join('?' * len(msg_ids))})",
+            msg_ids))
+        return [(i, rows[i]) for i in msg_ids if i in rows]
+
+catalog = TrackCatalog(CATALOG_PATH, (TELEGRAM_CHANNEL or "").strip())
+_catalog_sync_task: Optional[asyncio.Task] = None
+_catalog_handlers_added = False
+
+async def _on_tg_message(event):
+    entry = tg_audio_entry(event.message)
+    if entry:
+        catalog.upsert([entry])
+    else:
+        # Отредактировали так, что аудио больше нет
+        catalog.delete([event.message.id])
+
+async def _on_tg_deleted(event):
+    catalog.delete(event.deleted_ids)
+
+async def sync_catalog():
+    """Догоняет каталог: всё, что новее последнего известного msg_id."""
+    global _catalog_handlers_added
+    if process_role == "worker":
+        # Каталог пишет координатор, воркер только ждёт его и перечитывает базу
+        await coordinator_call({"op": "ensure_catalog"})
+        catalog.refresh()
+        return
+    entity = await get_tg_entity()
+    if not _catalog_handlers_added:
+        # Подписываемся до догоняющего прохода, чтобы не потерять сообщения между ними
+        tele_client.add_event_handler(_on_tg_message, events.NewMessage(chats=entity))
+        tele_client.add_event_handler(_on_tg_message, events.MessageEdited(chats=entity))
+        tele_client.add_event_handler(_on_tg_deleted, events.MessageDeleted(chats=entity))
+        _catalog_handlers_added = True
+
+    # reverse=True идёт от старых к новым, поэтому прерванная сборка продолжится
+    # с отметки synced_id. max_id() для этого не годится: живые сообщения,
+    # пришедшие во время сборки, уже лежат в каталоге далеко впереди прохода
+    batch: list[CatalogEntry] = []
+    last = catalog.synced_id()
+    scan = tele_client.iter_messages(entity, min_id=last, reverse=True)
+    async for msg in tg_gate.iterate(scan):
+        last = msg.id
+        entry = tg_audio_entry(msg)
+        if entry:
+            batch.append(entry)
+        if len(batch) >= 200:
+            catalog.upsert(batch, synced_to=last)
+            batch.clear()
+    catalog.upsert(batch, synced_to=last)
+    print(f"[catalog] синхронизирован, треков: {catalog.count()}")
+
+def catalog_ready() -> bool:
+    task = _catalog_sync_task
+    return task is not None and task.done() and not task.cancelled() and task.exception() is None
+
+async def ensure_catalog():
+    """Дожидается синхронизации каталога (запускает её, если ещё не было)."""
+    global _catalog_sync_task
+    task = _catalog_sync_task
+    if task is None or (task.done() and (task.cancelled() or task.exception())):
+        task = _catalog_sync_task = asyncio.create_task(sync_catalog())
+    await asyncio.shield(task)
+
+# ────────────────────────────────────────────────────────────────────────────
+# Кэш аудио (TEMP_DIR)
+# ────────────────────────────────────────────────────────────────────────────
+
+LEGACY_CACHE_NAME_RE = re.compile(r"_\d+$")   # старые файлы вида "{title}_{msg_id}"
+
+def _sha256_file(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+class AudioCache:
+    """
+    Файлы хранятся под sha256 содержимого, document id TG ссылается на хэш —
+    репосты одного и того же файла занимают место один раз.
+    Индекс лежит в CACHE_INDEX_PATH, лишнее сверх max_bytes выселяется по LRU.
+    """
+
+    def __init__(self, root: str, index_path: str, max_bytes: int):
+        self.root = root
+        self.index_path = index_path
+        self.max_bytes = max_bytes
+        self.entries: dict[str, dict] = {}   # sha256 -> {path, size, last_used, codec}
+        self.docs: dict[str, str] = {}       # document id -> sha256
+        self.trash: set[str] = set()         # заменённые .opus-версией, но ещё игравшие файлы
+        self.readonly = False                # воркер шардов: индекс пишет только координатор
+        self._index_mtime: Optional[int] = None
+        self._dirty = False                  # last_used поменялся, а индекс ещё не записан
+        self._flush_pending = False
+        self.touched: set[str] = set()       # readonly: попадания, о которых ещё не знает координатор
+        self.touched_event = asyncio.Event()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self.entries = data.get("entries", {})
+            self.docs = data.get("docs", {})
+            self.trash = set(data.get("trash", []))
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            print(f"[cache] индекс повреждён, начинаю с пустого: {e}")
+        self.entries = {h: e for h, e in self.entries.items() if os.path.isfile(e["path"])}
+        self.docs = {d: h for d, h in self.docs.items() if h in self.entries}
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name.endswith(".opus.tmp"):
+                os.remove(path)
+                continue
+            if name.endswith(".part.json"):
+                if not os.path.exists(path[:-len(".json")]):
+                    os.remove(path)
+                continue
+            if name.endswith(".part"):
+                # Недокачанное с картой частей можно докачать, но не вечно
+                resumable = os.path.exists(path + ".json")
+                if not resumable or time.time() - os.path.getmtime(path) > RESUME_MAX_AGE:
+                    os.remove(path)
+                    if resumable:
+                        os.remove(path + ".json")
+
+    def save(self):
+        if self.readonly:
+            return
+        self._dirty = False
+        tmp = self.index_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"entries": self.entries, "docs": self.docs, "trash": sorted(self.trash)}, f)
+        os.replace(tmp, self.index_path)
+
+    def refresh(self):
+        """Перечитывает индекс, если его переписал координатор (только для readonly)."""
+        try:
+            mtime = os.stat(self.index_path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self._index_mtime:
+            return
+        self._index_mtime = mtime
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        self.entries = data.get("entries", {})
+        self.docs = data.get("docs", {})
+        self.trash = set(data.get("trash", []))
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(e["size"] for e in self.entries.values())
+
+    def lookup(self, doc_id: Optional[int]) -> Optional[str]:
+        if doc_id is None:
+            return None
+        if self.readonly:
+            self.refresh()
+        digest = self.docs.get(str(doc_id))
+        entry = self.entries.get(digest) if digest else None
+        if not entry:
+            return None
+        if not os.path.isfile(entry["path"]):
+            del self.entries[digest]
+            return None
+        self.touch(entry)
+        return entry["path"]
+
+    def touch(self, entry: dict):
+        """Отмечает использование файла; индекс допишется не сразу, а через CACHE_INDEX_FLUSH_DELAY."""
+        entry["last_used"] = time.time()
+        if self.readonly:
+            self.touched.add(entry["path"])
+            self.touched_event.set()
+            return
+        self._dirty = True
+        if not self._flush_pending:
+            self._flush_pending = True
+            asyncio.get_running_loop().call_later(CACHE_INDEX_FLUSH_DELAY, self.flush)
+
+    def flush(self):
+        self._flush_pending = False
+        if self._dirty:
+            try:
+                self.save()
+            except OSError as e:
+                print(f"[cache] не удалось записать индекс: {e}")
+
+    async def add(self, doc_id: Optional[int], tmp_path: str, ext: str) -> str:
+        """Кладёт скачанный файл в кэш и возвращает его постоянный путь."""
+        digest = await asyncio.get_running_loop().run_in_executor(None, _sha256_file, tmp_path)
+        entry = self.entries.get(digest)
+        if entry and os.path.isfile(entry["path"]):
+            os.remove(tmp_path)
+        else:
+            path = os.path.join(self.root, digest + ext)
+            os.replace(tmp_path, path)
+            entry = self.entries[digest] = {"path": path, "size": os.path.getsize(path)}
+        entry["last_used"] = time.time()
+        if doc_id is not None:
+            self.docs[str(doc_id)] = digest
+        self.evict(keep=(entry["path"],))
+        if OPUS_TRANSCODE and entry.get("codec") != "opus":
+            asyncio.create_task(self._transcode_to_opus(digest))
+        return entry["path"]
+
+    def _entry_by_path(self, path: str) -> Optional[dict]:
+        return next((e for e in self.entries.values() if e["path"] == path), None)
+
+    async def codec_of(self, path: str) -> Optional[str]:
+        """Кодек файла; для файлов из кэша пробуется один раз и запоминается в индексе."""
+        entry = self._entry_by_path(path)
+        if entry is not None and "codec" in entry:
+            return entry["codec"]
+        codec, _ = await discord.FFmpegOpusAudio.probe(path)
+        entry = self._entry_by_path(path)
+        if entry is not None:
+            entry["codec"] = codec
+            self.save()
+        return codec
+
+    async def _transcode_to_opus(self, digest: str):
+        """Один раз перекодирует файл кэша в Ogg/Opus: дальше он играет без кодирования."""
+        entry = self.entries.get(digest)
+        if entry is None or await self.codec_of(entry["path"]) == "opus":
+            return
+        src = entry["path"]
+        dst = os.path.join(self.root, digest + ".opus")
+        async with _transcode_slots:
+            try:
+                proc = await asyncio.create_subprocess_exec(
+                    "ffmpeg", "-nostdin", "-loglevel", "error", "-y", "-i", src,
+                    "-vn", "-map_metadata", "-1", "-c:a", "libopus", "-b:a", f"{OPUS_BITRATE}k",
+                    "-ar", "48000", "-ac", "2", "-f", "ogg", dst + ".tmp",
+                    stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE,
+                )
+                _, err = await proc.communicate()
+            except OSError as e:
+                print(f"[cache] не удалось запустить ffmpeg для перекодирования: {e}")
+                return
+        if proc.returncode != 0:
+            print(f"[cache] перекодирование {src} не удалось: {err.decode(errors='ignore').strip()}")
+            if os.path.exists(dst + ".tmp"):
+                os.remove(dst + ".tmp")
+            return
+        os.replace(dst + ".tmp", dst)
+        entry = self.entries.get(digest)
+        if entry is None or entry["path"] != src:
+            os.remove(dst)   # пока кодировали, файл выселили
+            return
+        entry.update(path=dst, size=os.path.getsize(dst), codec="opus")
+        # Очереди ещё могут ссылаться на исходник — удалим его, когда отыграет
+        self.trash.add(src)
+        self.evict()
+
+    async def adopt_orphans(self):
+        """Заносит в индекс файлы, скачанные до появления кэша, схлопывая дубликаты."""
+        indexed = {e["path"] for e in self.entries.values()}
+        loop = asyncio.get_running_loop()
+        for name in sorted(os.listdir(self.root)):
+            path = os.path.join(self.root, name)
+            if path in indexed or not LEGACY_CACHE_NAME_RE.search(name) or not os.path.isfile(path):
+                continue
+            digest = await loop.run_in_executor(None, _sha256_file, path)
+            if digest in self.entries:
+                os.remove(path)
+                continue
+            self.entries[digest] = {
+                "path": path, "size": os.path.getsize(path), "last_used": os.path.getmtime(path),
+            }
+            entry = catalog.get(int(LEGACY_CACHE_NAME_RE.search(name).group()[1:]))
+            if entry and entry.document_id is not None:
+                self.docs.setdefault(str(entry.document_id), digest)
+        self.evict()
+
+    def evict(self, keep: Iterable[str] = ()):
+        """Выселяет самые давно игравшие файлы, пока кэш не влезет в max_bytes."""
+        protected = paths_in_use().union(keep)
+        for path in list(self.trash):
+            if path not in protected:
+                if os.path.exists(path):
+                    os.remove(path)
+                self.trash.discard(path)
+        total = self.total_bytes
+        for digest, entry in sorted(self.entries.items(), key=lambda kv: kv[1]["last_used"]):
+            if total <= self.max_bytes:
+                break
+            if entry["path"] in protected:
+                continue
+            try:
+                os.remove(entry["path"])
+            except FileNotFoundError:
+                pass
+            total -= entry["size"]
+            del self.entries[digest]
+        self.docs = {d: h for d, h in self.docs.items() if h in self.entries}
+        self.save()
+
+_transcode_slots = asyncio.Semaphore(1)   # фоновое перекодирование — по одному файлу за раз
+audio_cache = AudioCache(TEMP_DIR, CACHE_INDEX_PATH, CACHE_MAX_BYTES)
+
+# ────────────────────────────────────────────────────────────────────────────
+# Доступ к Telegram
+# ────────────────────────────────────────────────────────────────────────────
+
+class TelegramGate:
+    """
+    Общий вход для запросов к Telegram: ограничивает число одновременных
+    запросов, а FloodWait ставит на паузу сразу всех, а не только того,
+    кто на него нарвался.
+    """
+
+    def __init__(self, concurrency: int):
+        self._slots = asyncio.Semaphore(concurrency)
+        self._resume_at = 0.0
+        self.calls = 0      # одиночные запросы
+        self.steps = 0      # шаги итераторов (страница сообщений или кусок файла — из буфера или по сети)
+
+    async def call(self, make_request, retries: int = 3, count: bool = True):
+        for attempt in range(retries + 1):
+            delay = self._resume_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            async with self._slots:
+                if count:
+                    self.calls += 1
+                try:
+                    return await make_request()
+                except errors.FloodWaitError as e:
+                    if attempt == retries:
+                        raise
+                    self._resume_at = max(self._resume_at, time.monotonic() + e.seconds + 1)
+                    print(f"[telegram] FloodWait {e.seconds} с — притормаживаю все запросы")
+
+    async def iterate(self, iterator, retries: int = 3):
+        """
+        Проводит через шлюз итераторы Telethon (iter_messages, iter_download):
+        каждый шаг — под слотом и с паузой на FloodWait. Итератор Telethon
+        сдвигает смещение только после удачного запроса, так что шаг можно повторить.
+        """
+        while True:
+            try:
+                item = await self.call(iterator.__anext__, retries, count=False)
+            except StopAsyncIteration:
+                return
+            self.steps += 1
+            yield item
+
+tg_gate = TelegramGate(TG_MAX_CONCURRENT_CALLS)
+
+class MessageBatcher:
+    """
+    Склеивает одиночные get_messages, пришедшие почти одновременно
+    (окно предзагрузки, несколько гильдий), в один запрос ids=[...].
+    """
+
+    MAX_IDS = 100
+
+    def __init__(self, delay: float = 0.02):
+        self.delay = delay
+        self._pending: dict[int, list[asyncio.Future]] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+
+    async def get(self, msg_id: int):
+        fut = asyncio.get_running_loop().create_future()
+        self._pending.setdefault(msg_id, []).append(fut)
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush())
+        return await fut
+
+    async def _flush(self):
+        await asyncio.sleep(self.delay)
+        pending, self._pending, self._flush_task = self._pending, {}, None
+        ids = list(pending)
+        for i in range(0, len(ids), self.MAX_IDS):
+            chunk = ids[i:i + self.MAX_IDS]
+            try:
+                entity = await get_tg_entity()
+                msgs = await tg_gate.call(lambda: tele_client.get_messages(entity, ids=chunk))
+            except Exception as e:
+                for msg_id in chunk:
+                    for fut in pending[msg_id]:
+                        if not fut.done():
+                            fut.set_exception(e)
+                continue
+            for msg_id, msg in zip(chunk, msgs):
+                for fut in pending[msg_id]:
+                    if not fut.done():
+                        fut.set_result(msg)
+
+message_batcher = MessageBatcher()
+
+# ────────────────────────────────────────────────────────────────────────────
+# Загрузка из Telegram
+# ────────────────────────────────────────────────────────────────────────────
+
+NON_STREAMABLE_EXTS = {".m4a", ".mp4"}   # moov-атом бывает в конце файла — из пайпа не прочитать
+PARALLEL_PART_SIZE = 512 * 1024          # GetFile: кусок не должен пересекать границу 1 MB
+PARALLEL_PART_RETRIES = 5
+
+_active_downloads: dict[int, "TgDownload"] = {}   # document id -> идущая загрузка
+
+class _CdnRedirect(Exception):
+    """Файл отдаётся через CDN — качаем последовательно: _download_sequential умеет идти на CDN."""
+
+class TgDownload:
+    """
+    Загрузка документа TG в .part-файл, который можно читать, пока он растёт.
+    Готовый файл переезжает в audio_cache.
+    """
+
+    def __init__(self, msg):
+        doc_id = msg.document.id if msg.document else None
+        self._init_state(
+            msg, doc_id, msg.file.size or 0,
+            os.path.splitext(msg.file.name or "")[1].lower() or (msg.file.ext or ""),
+            os.path.join(TEMP_DIR, f"{doc_id or msg.id}_{uuid.uuid4().hex[:8]}.part"),
+        )
+        self.parallel = self.size >= PARALLEL_DOWNLOAD_MIN_BYTES and self.doc_id is not None
+        if self.parallel:
+            # Постоянное имя — чтобы после сбоя докачать, а не начинать заново
+            self.part_path = os.path.join(TEMP_DIR, f"{self.doc_id}.part")
+        if self.doc_id is not None:
+            _active_downloads[self.doc_id] = self
+        self.task = asyncio.create_task(self._run())
+
+    def _init_state(self, msg, doc_id: Optional[int], size: int, ext: str, part_path: str):
+        """Общее состояние загрузки и её читателей (и для RemoteDownload)."""
+        self.msg = msg
+        self.doc_id = doc_id
+        self.size = size
+        self.ext = ext
+        self.part_path = part_path
+        self.written = 0            # сколько байт с начала файла уже на диске
+        self.finished = False       # запись закончена (успешно или нет)
+        self.failed = False
+        self.path: Optional[str] = None
+        self._cond = threading.Condition()   # для читателей из потоков FFmpeg
+        self._progress = asyncio.Event()
+        self.users = 0              # сколько ждущих; отменяем, только когда не осталось никого
+        self.abandoned = False      # отменена, но ещё не успела прибраться
+        self.parallel = False
+
+    async def _run(self) -> str:
+        started = time.monotonic()
+        resume = False
+        try:
+            if self.parallel:
+                try:
+                    fetched = await self._download_parallel()
+                except _CdnRedirect:
+                    if os.path.exists(self.part_path + ".json"):
+                        os.remove(self.part_path + ".json")
+                    self.parallel = False   # докачивать по карте кусков больше нечего
+                    self._set_written(0)
+                    fetched = await self._download_sequential()
+            else:
+                fetched = await self._download_sequential()
+            self._finish(failed=False)
+            elapsed = max(time.monotonic() - started, 1e-6)
+            metrics.observe("download", elapsed)
+            metrics.observe("download", fetched / elapsed, family="bot_download_bytes_per_second")
+            print(f"[download] {self.msg.file.name or self.doc_id}: {fetched / 2**20:.1f} MB "
+                  f"за {elapsed:.1f} с ({fetched / 2**20 / elapsed:.2f} MB/s"
+                  f"{f', соединений: {PARALLEL_DOWNLOAD_CONNECTIONS}' if self.parallel else ''})")
+            self.path = await audio_cache.add(self.doc_id, self.part_path, self.ext)
+            return self.path
+        except Exception:
+            self._finish(failed=True)
+            resume = self.parallel
+            raise
+        except BaseException:
+            self._finish(failed=True)
+            raise
+        finally:
+            if _active_downloads.get(self.doc_id) is self:
+                del _active_downloads[self.doc_id]
+            # Открытые читатели дочитают уже скачанное по своим дескрипторам.
+            # Упавшую параллельную загрузку оставляем на диске для докачки.
+            if not resume and os.path.exists(self.part_path):
+                os.remove(self.part_path)
+            if not resume and os.path.exists(self.part_path + ".json"):
+                os.remove(self.part_path + ".json")
+
+    async def _download_sequential(self) -> int:
+        # По сообщению Telethon обновит протухшую file reference посреди загрузки
+        msg_data = (self.msg.input_chat, self.msg.id) if self.msg.input_chat else None
+        # Без буфера: что записано, то уже видно читателям по их дескрипторам
+        with open(self.part_path, "wb", buffering=0) as f:
+            chunks = tele_client._iter_download(self.msg.document, file_size=self.size, msg_data=msg_data)
+            try:
+                async for chunk in tg_gate.iterate(chunks):
+                    f.write(chunk)
+                    self._set_written(self.written + len(chunk))
+            except TelethonCdnRedirect:
+                # iter_download сам на CDN не идёт — это умеет только _download_file
+                await tg_gate.call(lambda: self._download_from_cdn(f, msg_data))
+        return self.written
+
+    async def _download_from_cdn(self, f, msg_data):
+        """Файл целиком через _download_file (он следует FileCdnRedirect), с начала."""
+        f.seek(0)
+        f.truncate()
+        self._set_written(0)   # читатели подождут: содержимое то же, перечитывать им не придётся
+        await tele_client._download_file(
+            self.msg.document, f, file_size=self.size, msg_data=msg_data,
+            progress_callback=lambda done, total: self._set_written(done),
+        )
+
+    async def _download_parallel(self) -> int:
+        """
+        Качает куски по PARALLEL_PART_SIZE несколькими одновременными GetFileRequest
+        в заранее выделенный файл. Куски берутся по порядку, так что начало файла
+        (а с ним и стриминг) продвигается без дыр. Карта готовых кусков лежит
+        рядом в .part.json — после сбоя докачивается только недостающее.
+        """
+        part = PARALLEL_PART_SIZE
+        nparts = -(-self.size // part)
+        state_path = self.part_path + ".json"
+        done = self._load_resume_state(state_path)
+        if not done or not os.path.exists(self.part_path):
+            done = set()
+            with open(self.part_path, "wb") as f:
+                f.truncate(self.size)
+        todo = deque(i for i in range(nparts) if i not in done)
+        self._advance_parts(done)
+
+        dc_id = self.msg.document.dc_id
+        sender = None
+        if dc_id != tele_client.session.dc_id:
+            sender = await tele_client._borrow_exported_sender(dc_id)
+        fetched = 0
+
+        with open(self.part_path, "r+b") as f:
+            def save_state():
+                f.flush()
+                with open(state_path, "w", encoding="utf-8") as sf:
+                    json.dump({"size": self.size, "part_size": part, "done": sorted(done)}, sf)
+
+            async def worker():
+                nonlocal fetched
+                while todo:
+                    i = todo.popleft()
+                    data = await self._fetch_part(sender, i * part, part)
+                    f.seek(i * part)
+                    f.write(data)
+                    done.add(i)
+                    fetched += len(data)
+                    if len(done) % 16 == 0:
+                        save_state()
+                    self._advance_parts(done)
+
+            workers = [asyncio.create_task(worker())
+                       for _ in range(min(PARALLEL_DOWNLOAD_CONNECTIONS, len(todo)))]
+            try:
+                await asyncio.gather(*workers)
+            except Exception:
+                for w in workers:
+                    w.cancel()
+                save_state()
+                raise
+            finally:
+                for w in workers:
+                    w.cancel()
+                if sender is not None:
+                    await tele_client._return_exported_sender(sender)
+        return fetched
+
+    async def _fetch_part(self, sender, offset: int, limit: int) -> bytes:
+        for attempt in range(PARALLEL_PART_RETRIES):
+            _, location = utils.get_input_location(self.msg.document)
+            request = GetFileRequest(location, offset=offset, limit=limit)
+            try:
+                # FloodWait не глотаем внутри Telethon — пусть tg_gate притормозит всех
+                if sender is not None:
+                    result = await tg_gate.call(
+                        lambda: tele_client._call(sender, request, flood_sleep_threshold=0))
+                else:
+                    result = await tg_gate.call(
+                        lambda: tele_client(request, flood_sleep_threshold=0))
+            except errors.FileReferenceExpiredError:
+                msg = await get_tg_message(self.msg.id)
+                if msg is None or not msg.document:
+                    raise RuntimeError("сообщение удалено из канала")
+                self.msg = msg
+                continue
+            except (OSError, asyncio.TimeoutError, errors.ServerError, errors.TimedOutError) as e:
+                if attempt == PARALLEL_PART_RETRIES - 1:
+                    raise
+                print(f"[download] кусок {offset} не пришёл ({e!r}), повторяю")
+                await asyncio.sleep(0.5 * 2 ** attempt)
+                continue
+            if isinstance(result, FileCdnRedirect):
+                raise _CdnRedirect()
+            return result.bytes
+        raise RuntimeError(f"не удалось скачать кусок {offset} за {PARALLEL_PART_RETRIES} попыток")
+
+    def _load_resume_state(self, state_path: str) -> set[int]:
+        try:
+            with open(state_path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return set()
+        if state.get("size") != self.size or state.get("part_size") != PARALLEL_PART_SIZE:
+            return set()
+        print(f"[download] докачиваю {self.msg.file.name or self.doc_id}: "
+              f"готово {len(state['done'])} кусков")
+        return set(state["done"])
+
+    def _advance_parts(self, done: set[int]):
+        n = self.written // PARALLEL_PART_SIZE
+        while n in done:
+            n += 1
+        self._set_written(min(n * PARALLEL_PART_SIZE, self.size))
+
+    def _set_written(self, n: int):
+        with self._cond:
+            self.written = n
+            self._cond.notify_all()
+        self._progress.set()
+
+    def _finish(self, failed: bool):
+        with self._cond:
+            self.finished = True
+            self.failed = failed
+            self._cond.notify_all()
+        self._progress.set()
+
+    async def wait_buffered(self, nbytes: int):
+        while self.written < nbytes and not self.finished:
+            self._progress.clear()
+            await self._progress.wait()
+
+    async def wait(self) -> str:
+        return await asyncio.shield(self.task)
+
+    def acquire(self):
+        self.users += 1
+
+    def release(self):
+        self.users -= 1
+        if self.users <= 0 and not self.finished:
+            self.abandoned = True
+            self.task.cancel()
+
+    def open_reader(self) -> "GrowingFileReader":
+        return GrowingFileReader(self)
+
+class GrowingFileReader:
+    """Файловый объект для pipe=True у FFmpeg: блокируется, пока загрузка не догонит."""
+
+    def __init__(self, dl: TgDownload):
+        self.dl = dl
+        self.pos = 0
+        self.f = open(dl.path or dl.part_path, "rb")
+
+    def read(self, n: int = -1) -> bytes:
+        dl = self.dl
+        with dl._cond:
+            while self.pos >= dl.written and not dl.finished:
+                dl._cond.wait()
+            available = dl.written - self.pos
+        if available <= 0:
+            self.f.close()
+            return b""
+        data = self.f.read(available if n < 0 else min(n, available))
+        self.pos += len(data)
+        return data
+
 # ────────────────────────────────────────────────────────────────────────────
 # Хелперы
 # ────────────────────────────────────────────────────────────────────────────
@@ -94,19 +1302,47 @@ def channel_has_listeners(vc: Optional[discord.VoiceClient]) -> bool:
         return False
     return any(not m.bot for m in vc.channel.members)
 
+def paths_in_use() -> set[str]:
+    """
+    Файлы, которые сейчас играют или стоят в очереди хоть в одной гильдии —
+    у координатора шардов это гильдии воркеров (см. _shard_pins).
+    """
+    paths = set()
+    for player in players.values():
+        for t in (player.now_playing, *player.queue):
+            if t and t.filepath:
+                paths.add(t.filepath)
+    now = time.monotonic()
+    for seen, pinned in _shard_pins.values():
+        if now - seen < 3 * SHARD_PIN_INTERVAL:   # молчащий воркер упал — его файлы больше не держим
+            paths |= pinned
+    return paths
+
 async def ensure_player(guild: discord.Guild) -> GuildPlayer:
     if guild.id not in players:
-        players[guild.id] = GuildPlayer()
+        player = players[guild.id] = GuildPlayer(guild_id=guild.id)
+        player.task = asyncio.create_task(player_loop(player), name=f"player-{guild.id}")
+        touch_idle(player)   # плеер без голоса (/queue, /skip без /play) тоже должен уйти по таймеру
     return players[guild.id]
 
+_tg_entity = None
+_tg_entity_lock = asyncio.Lock()
+
 async def get_tg_entity():
+    """Канал TELEGRAM_CHANNEL; резолвится один раз на процесс."""
+    global _tg_entity
+    if _tg_entity is not None:
+        return _tg_entity
     chan = (TELEGRAM_CHANNEL or "").strip()
     if not chan:
         raise RuntimeError("TELEGRAM_CHANNEL пуст")
-    try:
-        return await tele_client.get_entity(chan)
-    except Exception as e:
-        raise RuntimeError(f"Не удалось получить канал по TELEGRAM_CHANNEL='{chan}': {e}")
+    async with _tg_entity_lock:
+        if _tg_entity is None:
+            try:
+                _tg_entity = await tg_gate.call(lambda: tele_client.get_entity(chan))
+            except Exception as e:
+                raise RuntimeError(f"Не удалось получить канал по TELEGRAM_CHANNEL='{chan}': {e}")
+    return _tg_entity
 
 async def connect_to_author_channel(interaction: discord.Interaction) -> discord.VoiceClient:
     if not interaction.user or not isinstance(interaction.user, discord.Member):
@@ -122,141 +1358,730 @@ async def connect_to_author_channel(interaction: discord.Interaction) -> discord
         player.voice = await voice_state.channel.connect(self_deaf=True)
     return player.voice
 
-async def search_telegram_audios(query: Optional[str], limit: int = 20):
-    entity = await get_tg_entity()
-    results = []
-    async for msg in tele_client.iter_messages(entity, search=query or None, limit=200):
-        if isinstance(msg.media, MessageMediaDocument) and msg.file:
-            mime = getattr(msg.file, "mime_type", "") or ""
-            name = msg.file.name or f"audio_{msg.id}"
-            ext = os.path.splitext(name)[1].lower()
-            if mime.startswith(SUPPORTED_AUDIO_MIME_PREFIXES) or ext in SUPPORTED_EXTS:
-                title = (msg.message or name).strip()[:200] if msg.message else name
-                results.append((msg, title))
-                if len(results) >= limit:
-                    break
-    return results
+async def search_telegram_audios(query: Optional[str], limit: int = 20) -> list[CatalogEntry]:
+    await ensure_catalog()
+    catalog.refresh()
+    if not query:
+        return catalog.latest(limit)
+    m = PICK_BY_ID_RE.match(query.strip())
+    if m:
+        entry = catalog.get(int(m.group(1)))
+        return [entry] if entry else []
+    return [e for e in (catalog.get(i) for i, _ in catalog.index.search(query, limit)) if e]
+
+async def get_tg_message(msg_id: int):
+    return await message_batcher.get(msg_id)
+
+async def start_tg_download(track: Track) -> Optional["TgDownload"]:
+    """
+    Берёт TG-трек из кэша (выставляет filepath) или запускает его загрузку.
+    Уже идущая загрузка того же документа (в любой гильдии) переиспользуется.
+    Вызывающий получает свою ссылку на загрузку и, если она больше не нужна,
+    отдаёт её через release().
+    """
+    dl = track.download
+    if dl is None or dl.failed or dl.abandoned:
+        if process_role == "worker":
+            cached, dl = await open_remote_download(track.source_msg_id)
+        else:
+            cached, dl = await open_tg_download(track.source_msg_id)
+        if cached:
+            track.filepath = cached
+            return None
+    dl.acquire()
+    track.download = dl
+    return dl
+
+async def open_tg_download(msg_id: int) -> tuple[Optional[str], Optional["TgDownload"]]:
+    """Путь из кэша или идущая (новая либо уже начатая кем-то) загрузка документа."""
+    msg = await get_tg_message(msg_id)
+    if msg is None:
+        raise RuntimeError("сообщение удалено из канала")
+    doc_id = msg.document.id if msg.document else None
+    cached = audio_cache.lookup(doc_id)
+    if cached:
+        return cached, None
+    dl = _active_downloads.get(doc_id)
+    if dl is not None and dl.abandoned:
+        # Дождёмся, пока отменённая загрузка уберёт свой .part, и начнём заново
+        await asyncio.wait([dl.task])
+        dl = None
+    if dl is None or dl.failed:
+        dl = TgDownload(msg)
+    return None, dl
+
+async def prepare_tg_track(track: Track):
+    """
+    Готовит TG-трек к игре. Если файла ещё нет, ждёт только первые
+    STREAM_START_BYTES — остальное FFmpeg дочитает по мере загрузки.
+    """
+    dl = await start_tg_download(track)
+    if dl is None:
+        return
+    try:
+        if dl.ext in NON_STREAMABLE_EXTS:
+            track.filepath = await dl.wait()
+            return
+        await dl.wait_buffered(STREAM_START_BYTES)
+    except asyncio.CancelledError:
+        dl.release()
+        raise
+    if dl.failed:
+        raise RuntimeError("загрузка оборвалась")
+    if dl.path:
+        track.filepath = dl.path
+        return
 
-async def download_audio(msg, title: str) -> str:
-    safe = "".join(c for c in title if c.isalnum() or c in " _-()[]{}.,!")
-    base = safe or f"audio_{msg.id}"
-    tmp_path = os.path.join(TEMP_DIR, f"{base}_{msg.id}")
-    return await tele_client.download_media(msg, file=tmp_path)
+    def remember_path(task: asyncio.Task):
+        if not task.cancelled() and task.exception() is None:
+            track.filepath = task.result()
+            track.download = None
+    dl.task.add_done_callback(remember_path)
 
-async def collect_all_tg_audios(max_items: int = 2000) -> list[tuple]:
+# ────────────────────────────────────────────────────────────────────────────
+# Предзагрузка очереди
+# ────────────────────────────────────────────────────────────────────────────
+
+_prefetch_slots = asyncio.Semaphore(PREFETCH_CONCURRENCY)
+
+async def _prefetch_track(track: Track):
+    async with _prefetch_slots:
+        dl = None
+        try:
+            dl = await start_tg_download(track)
+            if dl is not None:
+                track.filepath = await dl.wait()
+                track.download = None
+        except asyncio.CancelledError:
+            if dl is not None:
+                dl.release()
+            raise
+        except Exception as e:
+            # play_next увидит, что файла нет, и попробует ещё раз сам
+            if dl is not None:
+                dl.release()
+            print(f"[prefetch] не удалось скачать '{track.title}': {e}")
+
+def refresh_prefetch(player: GuildPlayer):
+    """
+    Держит фоновые загрузки ровно для первых PREFETCH_AHEAD TG-треков очереди
+    (YouTube-треки из этого окна заранее резолвятся).
+    Всё, что из этого окна выпало (skip, stop, новая очередь), отменяется.
     """
-    Собирает до max_items аудио-документов из TELEGRAM_CHANNEL.
-    Возвращает список пар (msg, title).
+    window = list(itertools.islice(player.queue, PREFETCH_AHEAD))
+    wanted = {
+        t.source_msg_id: t
+        for t in window
+        if t.filepath is None and t.source_msg_id is not None
+    }
+    for t in window:
+        if t.page_url:
+            warm_youtube(t.page_url)
+    for msg_id, task in list(player.prefetch.items()):
+        if msg_id not in wanted:
+            task.cancel()
+            del player.prefetch[msg_id]
+    for msg_id, track in wanted.items():
+        if msg_id not in player.prefetch:
+            player.prefetch[msg_id] = asyncio.create_task(_prefetch_track(track))
+    refresh_preload(player)
+
+async def iter_shuffled_tg_audio(max_items: int, batch_size: int = SHUFFLE_BATCH
+                                 ) -> AsyncIterator[list[tuple[int, str]]]:
     """
+    Последние max_items аудио канала пачками компактных (msg_id, title).
+    Из готового каталога пачки сразу идут в случайном порядке (перемешиваются
+    только id). Пока каталог строится, идём по каналу вживую от новых к старым,
+    не держа сообщения в памяти, — перемешивает уже merge_shuffled.
+    """
+    if process_role == "worker":
+        await ensure_catalog()   # у воркера нет своего Telegram — только каталог
+    if catalog_ready():
+        ids = catalog.latest_ids(max_items)
+        random.shuffle(ids)
+        for i in range(0, len(ids), batch_size):
+            yield catalog.titles(ids[i:i + batch_size])
+        return
+
     entity = await get_tg_entity()
-    results = []
-    async for msg in tele_client.iter_messages(entity, limit=max_items):
-        if isinstance(msg.media, MessageMediaDocument) and msg.file:
-            mime = getattr(msg.file, "mime_type", "") or ""
-            name = msg.file.name or f"audio_{msg.id}"
-            ext = os.path.splitext(name)[1].lower()
-            if mime.startswith(SUPPORTED_AUDIO_MIME_PREFIXES) or ext in SUPPORTED_EXTS:
-                title = (msg.message or name).strip()[:200] if msg.message else name
-                results.append((msg, title))
-    return results
-
-async def ytdlp_resolve(query: str) -> tuple[str, str]:
-    with YoutubeDL(YDL_OPTS) as ydl:
-        info = ydl.extract_info(query, download=False)
-        if "entries" in info and info["entries"]:
-            info = info["entries"][0]
-        title = info.get("title") or "YouTube Audio"
-        direct_url = info.get("url")
-        if not direct_url:
-            for f in reversed(info.get("formats") or []):
-                if f.get("acodec") and f.get("url"):
-                    direct_url = f["url"]
-                    break
-        if not direct_url:
-            raise RuntimeError("Не удалось получить прямой аудио-URL (YouTube)")
-        return title, direct_url
+    batch: list[tuple[int, str]] = []
+    async for msg in tg_gate.iterate(tele_client.iter_messages(entity, limit=max_items)):
+        entry = tg_audio_entry(msg)
+        if entry:
+            batch.append((entry.msg_id, entry.title))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def merge_shuffled(player: GuildPlayer, owned: dict[int, Track], batch: list[Track]):
+    """
+    Подмешивает пачку в ещё не сыгранную часть перемешанной очереди так,
+    чтобы порядок оставался равномерно случайным. Первые PREFETCH_AHEAD позиций
+    не трогаем (они уже качаются), чужие треки остаются на своих местах.
+    """
+    items = list(player.queue)
+    slots = [i for i, t in enumerate(items) if i >= PREFETCH_AHEAD and id(t) in owned]
+    pool = [items[i] for i in slots] + batch
+    random.shuffle(pool)
+    for i, t in zip(slots, pool):
+        items[i] = t
+    items.extend(pool[len(slots):])
+    player.queue.clear()
+    player.queue.extend(items)
+    owned.update((id(t), t) for t in batch)
+
+
+_ydl: Optional[YoutubeDL] = None        # прогретые экземпляры внутри процесса пула
+_ydl_flat: Optional[YoutubeDL] = None
+
+def _ytdlp_worker_init(opts: dict, flat_opts: dict):
+    global _ydl, _ydl_flat
+    _ydl = YoutubeDL(opts)
+    _ydl.get_info_extractor("Youtube")   # экстракторы инициализируются лениво — делаем это заранее
+    _ydl.get_info_extractor("YoutubeSearch")
+    _ydl_flat = YoutubeDL(flat_opts)
+    _ydl_flat.get_info_extractor("YoutubeTab")
+
+def ytdlp_playlist(url: str) -> tuple[str, list[tuple[str, str]]]:
+    """Название плейлиста и пары (название, ссылка на видео) без разбора форматов."""
+    ydl = _ydl_flat or YoutubeDL(YDL_FLAT_OPTS)
+    info = ydl.extract_info(url, download=False)
+    entries = []
+    for e in info.get("entries") or []:
+        if not e:
+            continue
+        page = e.get("url") or e.get("webpage_url")
+        if not page and e.get("id"):
+            page = f"https://www.youtube.com/watch?v={e['id']}"
+        if page:
+            entries.append((e.get("title") or page, page))
+    return info.get("title") or "YouTube плейлист", entries
+
+def ytdlp_resolve(query: str) -> tuple[str, str, Optional[str], Optional[str]]:
+    ydl = _ydl or YoutubeDL(YDL_OPTS)
+    info = ydl.extract_info(query, download=False)
+    if "entries" in info and info["entries"]:
+        info = info["entries"][0]
+    title = info.get("title") or "YouTube Audio"
+    direct_url = info.get("url")
+    acodec = info.get("acodec")
+    if not direct_url:
+        for f in reversed(info.get("formats") or []):
+            if f.get("acodec") and f.get("url"):
+                direct_url = f["url"]
+                acodec = f["acodec"]
+                break
+    if not direct_url:
+        raise RuntimeError("Не удалось получить прямой аудио-URL (YouTube)")
+    return title, direct_url, acodec, info.get("webpage_url")
+
+_ytdlp_pool: Optional[ProcessPoolExecutor] = None
+
+def start_ytdlp_pool():
+    """
+    Поднимает пул процессов yt-dlp. Вызывать до старта event loop и потоков:
+    с fork процессы создаются сразу при первой задаче.
+    """
+    global _ytdlp_pool
+    if YTDLP_WORKERS <= 0:
+        return
+    ctx = multiprocessing.get_context("fork") if "fork" in multiprocessing.get_all_start_methods() else None
+    _ytdlp_pool = ProcessPoolExecutor(
+        max_workers=YTDLP_WORKERS, mp_context=ctx,
+        initializer=_ytdlp_worker_init, initargs=(YDL_OPTS, YDL_FLAT_OPTS),
+    )
+    for _ in range(YTDLP_WORKERS):
+        _ytdlp_pool.submit(int)
+
+@dataclass
+class ResolvedStream:
+    title: str
+    url: str
+    codec: Optional[str]
+    expires_at: float
+    page_url: Optional[str] = None
+
+    @property
+    def fresh(self) -> bool:
+        return self.expires_at - YTDLP_EXPIRY_MARGIN > time.time()
+
+STREAM_EXPIRE_RE = re.compile(r"[?&/]expire[=/](\d+)")
+
+_ytdlp_cache: dict[str, ResolvedStream] = {}
+_ytdlp_inflight: dict[str, asyncio.Future] = {}
+
+async def run_ytdlp(func, arg: str):
+    global _ytdlp_pool
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(_ytdlp_pool, func, arg)
+    except BrokenProcessPool:
+        # Процесс пула умер — дальше живём на общем пуле потоков
+        print("[yt-dlp] пул процессов сломан, перехожу на потоки")
+        _ytdlp_pool = None
+        return await loop.run_in_executor(None, func, arg)
+
+async def _ytdlp_resolve_uncached(key: str) -> ResolvedStream:
+    with metrics.timer("ytdlp_resolve"):
+        title, url, codec, page_url = await run_ytdlp(ytdlp_resolve, key)
+    m = STREAM_EXPIRE_RE.search(url)
+    expires_at = int(m.group(1)) if m else time.time() + YTDLP_CACHE_TTL
+    resolved = _ytdlp_cache[key] = ResolvedStream(title, url, codec, expires_at, page_url)
+    if page_url:
+        # Поиск и ссылка на то же видео — одна запись (трек потом резолвится по ссылке)
+        _ytdlp_cache[page_url] = resolved
+    if len(_ytdlp_cache) > YTDLP_CACHE_MAX:
+        for k in [k for k, v in _ytdlp_cache.items() if not v.fresh]:
+            del _ytdlp_cache[k]
+        while len(_ytdlp_cache) > YTDLP_CACHE_MAX:
+            del _ytdlp_cache[next(iter(_ytdlp_cache))]
+    return resolved
+
+async def resolve_youtube(query: str) -> ResolvedStream:
+    """
+    Запрос/ссылка → прямой аудио-URL. Свежие ответы берутся из кэша (с учётом
+    expire= в ссылках googlevideo), одинаковые запросы из разных гильдий
+    в полёте объединяются в один.
+    """
+    key = query.strip()
+    hit = _ytdlp_cache.get(key)
+    if hit and hit.fresh:
+        return hit
+    fut = _ytdlp_inflight.get(key)
+    if fut is None:
+        fut = _ytdlp_inflight[key] = asyncio.ensure_future(_ytdlp_resolve_uncached(key))
+        fut.add_done_callback(lambda _: _ytdlp_inflight.pop(key, None))
+    return await asyncio.shield(fut)
+
+def warm_youtube(page_url: str):
+    """Резолвит ссылку заранее, в фоне — к началу трека URL будет в кэше."""
+    hit = _ytdlp_cache.get(page_url)
+    if (hit and hit.fresh) or page_url in _ytdlp_inflight:
+        return
+
+    async def warm():
+        try:
+            await resolve_youtube(page_url)
+        except Exception as e:
+            print(f"[yt-dlp] не удалось заранее получить {page_url}: {e}")
+    asyncio.create_task(warm())
 
 # ────────────────────────────────────────────────────────────────────────────
 # Воспроизведение
 # ────────────────────────────────────────────────────────────────────────────
 
 async def play_next(guild: discord.Guild):
+    """Будит player_loop гильдии: пусть посмотрит, не пора ли играть следующий трек."""
     player = await ensure_player(guild)
+    player.wake.set()
+
+async def player_loop(player: GuildPlayer):
+    """
+    Единственная корутина, которая переключает треки гильдии.
+    Просыпается по player.wake (конец трека, новая очередь, skip/stop).
+    """
+    while True:
+        await player.wake.wait()
+        player.wake.clear()
+        try:
+            await _advance(player)
+        except Exception as e:
+            player.state = PlayerState.IDLE
+            print(f"[player] ошибка при переключении трека: {e!r}")
+        touch_idle(player)
+
+async def _advance(player: GuildPlayer):
     vc = player.voice
 
     if not vc or not vc.is_connected():
+        drop_preload(player)
+        player.state = PlayerState.IDLE
+        return
+
+    if vc.is_playing() or vc.is_paused():
+        refresh_prefetch(player)
         return
 
     if not channel_has_listeners(vc):
         player.loop_current = False
         player.now_playing = None
+        player.state = PlayerState.IDLE
+        drop_preload(player)
         return
 
-    if vc.is_playing() or vc.is_paused():
-        return
+    # Неудачные треки пропускаем здесь же, циклом — без рекурсии и без блокировок
+    while True:
+        origin = next_track(player)
+        if origin is None:
+            player.now_playing = None
+            player.state = PlayerState.IDLE
+            player.audio_gap_from = None   # следующий трек начнётся не «после» этого
+            drop_preload(player)
+            return
 
-    if not player.queue and player.loop_current and player.now_playing:
-        t = player.now_playing
-        player.queue.appendleft(
-            Track(title=t.title, filepath=t.filepath,
-                  source_msg_id=t.source_msg_id, stream_url=t.stream_url)
-        )
+        # Следующий трек мог быть уже подготовлен заранее (skip, или не успели к концу трека)
+        ready = await claim_preloaded(player, origin)
+        if next_track(player) is not origin:
+            # Пока ждали, очередь поменяли (/stop и т.п.)
+            if ready:
+                discard_prepared(ready[1], ready[2])
+            continue
+
+        if player.queue and player.queue[0] is origin:
+            player.queue.popleft()
+            track = origin
+        else:
+            track = replace(origin, download=None, start_at=0.0)   # /loop: та же запись ещё раз
+        if ready:
+            track = ready[1]
+        player.now_playing = track
+        player.state = PlayerState.RESOLVING
+        pending = player.prefetch.pop(track.source_msg_id, None) if track.source_msg_id else None
+        refresh_prefetch(player)
+        if pending is not None and track.download is None and not ready:
+            pending.cancel()   # ещё ждал свободного слота — дальше качаем сами, без очереди
 
-    if not player.queue:
-        player.now_playing = None
+        try:
+            if ready:
+                source = ready[2]
+            else:
+                try:
+                    source = await make_audio_source(track, player.guild_id)
+                except Exception as e:
+                    print(f"[player] не удалось подготовить '{track.title}': {e}")
+                    discard_prepared(track)
+                    continue
+        finally:
+            if pending is not None:
+                # Своя ссылка на загрузку у трека уже есть — ссылка предзагрузки
+                # больше не нужна, иначе skip не сможет отменить загрузку
+                pending.cancel()
+
+        if player.now_playing is not track or not vc.is_connected() or vc.is_playing():
+            # Пока готовили источник, трек пропустили/остановили или голос отвалился
+            discard_prepared(track, source)
+            if player.now_playing is not track and vc.is_connected():
+                continue
+            return
+
+        loop = asyncio.get_running_loop()
+        player.chain = GaplessSource(player, loop, source, track, start_at=track.start_at)
+        track.start_at = 0.0   # /loop и повторы — с начала
+        vc.play(player.chain, after=lambda err: _on_track_end(loop, player, err))
+        player.state = PlayerState.PLAYING
+        refresh_preload(player)
         return
 
-    track = player.queue.popleft()
+def _on_track_end(loop: asyncio.AbstractEventLoop, player: GuildPlayer, err: Optional[Exception]):
+    # Вызывается из аудио-потока discord: только будим player_loop, ничего не ждём
+    if err:
+        print(f"[FFmpeg error]: {err}")
+    loop.call_soon_threadsafe(player.wake.set)
+
+# ────────────────────────────────────────────────────────────────────────────
+# Бесшовное переключение
+# ────────────────────────────────────────────────────────────────────────────
+
+class GaplessSource(discord.AudioSource):
+    """
+    То, что на самом деле играет voice.play. Когда источник текущего трека
+    кончается, тут же, в том же аудио-потоке, переключается на заранее
+    запущенный FFmpeg следующего трека — без нового voice.play и без паузы
+    на запуск процесса, probe и соединение.
+    """
+
+    def __init__(self, player: GuildPlayer, loop: asyncio.AbstractEventLoop, source: discord.AudioSource,
+                 track: Track, start_at: float = 0.0):
+        self.player = player
+        self.loop = loop
+        self.current = source
+        self.track = track         # чей источник сейчас в current
+        self._released = False
+        self.start_at = start_at   # позиция текущего трека = start_at + packets * 20 мс
+        self.packets = 0
+        self._source_started()
+
+    def is_opus(self) -> bool:
+        return True   # make_audio_source отдаёт только FFmpegOpusAudio
+
+    def _source_started(self):
+        self._awaiting_first = metrics.enabled
+        if self._awaiting_first:
+            self._since = time.perf_counter()
+
+    def _first_packet(self):
+        self._awaiting_first = False
+        now = time.perf_counter()
+        metrics.observe("first_packet", now - self._since, self.player.guild_id)
+        if self.player.audio_gap_from is not None:
+            metrics.observe("track_gap", now - self.player.audio_gap_from, self.player.guild_id)
+            self.player.audio_gap_from = None
+
+    def read(self) -> bytes:
+        while True:
+            data = self.current.read()
+            if data:
+                self.packets += 1
+                if self._awaiting_first:
+                    self._first_packet()
+                return data
+            if metrics.enabled and self.player.audio_gap_from is None:
+                self.player.audio_gap_from = time.perf_counter()
+            with self.player.preload_lock:
+                ready, self.player.preloaded = self.player.preloaded, None
+            if ready is None:
+                return b""
+            origin, track, source = ready
+            self.current.cleanup()
+            self.current, self.track = source, track
+            self.start_at, self.packets = 0.0, 0
+            self._source_started()
+            self.loop.call_soon_threadsafe(_on_handoff, self.player, self, origin, track)
+
+    @property
+    def position(self) -> float:
+        return self.start_at + self.packets * 0.02
+
+    def cleanup(self):
+        # Подготовленный следующий источник не трогаем: его заберёт player_loop после skip.
+        # Загрузку остановленного трека отпускаем (вызов из аудио-потока, возможно повторный).
+        self.current.cleanup()
+        if not self._released and not self.loop.is_closed():
+            self._released = True
+            self.loop.call_soon_threadsafe(discard_prepared, self.track)
+
+def _on_handoff(player: GuildPlayer, chain: GaplessSource, origin: Track, track: Track):
+    """GaplessSource уже играет следующий трек — догоняем состояние плеера."""
+    if player.chain is not chain or not player.voice or not player.voice.is_playing():
+        return   # успели сделать skip/stop — этот источник уже остановлен
+    if player.queue and player.queue[0] is origin:
+        player.queue.popleft()
+    if player.preload_for is origin:
+        player.preload_for, player.preload_task = None, None
     player.now_playing = track
+    player.state = PlayerState.PLAYING
+    refresh_prefetch(player)
 
-    if track.filepath is None and track.source_msg_id is not None:
-        try:
-            entity = await get_tg_entity()
-            msg = await tele_client.get_messages(entity, ids=track.source_msg_id)
-            path = await download_audio(msg, track.title)
-            track.filepath = path
-        except Exception as e:
-            print(f"[play_next] не удалось скачать TG-трек '{track.title}': {e}")
-            fut = asyncio.run_coroutine_threadsafe(play_next(guild), bot.loop)
-            try:
-                fut.result()
-            except Exception as ee:
-                print("[play_next] ошибка при планировании следующего:", ee)
-            return
+def next_track(player: GuildPlayer) -> Optional[Track]:
+    """Что играть после текущего: голова очереди или, при /loop, он же."""
+    if player.queue:
+        return player.queue[0]
+    if player.loop_current:
+        return player.now_playing
+    return None
+
+def _take_preloaded(player: GuildPlayer) -> Optional[tuple]:
+    with player.preload_lock:
+        ready, player.preloaded = player.preloaded, None
+    return ready
+
+def drop_preload(player: GuildPlayer):
+    """Гасит подготовку следующего трека и убивает уже запущенный для него FFmpeg."""
+    player.preload_for = None
+    if player.preload_task is not None:
+        player.preload_task.cancel()
+        player.preload_task = None
+    ready = _take_preloaded(player)
+    if ready:
+        discard_prepared(ready[1], ready[2])
+
+def discard_prepared(track: Track, source: Optional[discord.AudioSource] = None):
+    """
+    Подготовленный (или не подготовившийся) трек не пригодился: гасим FFmpeg
+    и отдаём ссылку на загрузку — без других ждущих она отменится.
+    """
+    if source is not None:
+        source.cleanup()
+    if track.download is not None:
+        track.download.release()
+        track.download = None
+
+def refresh_preload(player: GuildPlayer):
+    """Пока что-то играет, держит запущенным источник для next_track()."""
+    want = next_track(player) if player.now_playing is not None else None
+    if want is player.preload_for:
+        return
+    drop_preload(player)
+    if want is not None:
+        player.preload_for = want
+        player.preload_task = asyncio.create_task(_preload(player, want))
+
+async def _preload(player: GuildPlayer, origin: Track):
+    # Для /loop готовим копию: у играющей записи свой download и свой FFmpeg
+    track = origin if origin is not player.now_playing else replace(origin, download=None, start_at=0.0)
+    try:
+        source = await make_audio_source(track, player.guild_id)
+    except Exception as e:
+        print(f"[player] не удалось заранее подготовить '{track.title}': {e}")
+        discard_prepared(track)
+        return
+    if player.preload_for is not origin:
+        discard_prepared(track, source)
+        return
+    with player.preload_lock:
+        player.preloaded = (origin, track, source)
 
-    def after_play(err: Optional[Exception]):
-        if err:
-            print(f"[FFmpeg error]: {err}")
-        fut = asyncio.run_coroutine_threadsafe(play_next(guild), bot.loop)
-        try:
-            fut.result()
-        except Exception as ee:
-            print("[play_next] ошибка при планировании следующего:", ee)
+async def claim_preloaded(player: GuildPlayer, origin: Track) -> Optional[tuple]:
+    """
+    Забирает заранее подготовленный источник для origin (дождавшись подготовки,
+    если она ещё идёт). Всё подготовленное для другого трека гасится.
+    """
+    task = player.preload_task
+    if player.preload_for is origin and task is not None and not task.done():
+        await asyncio.wait([task])
+    ready = None
+    if player.preload_for is origin:
+        ready = _take_preloaded(player)
+        player.preload_for, player.preload_task = None, None
+    drop_preload(player)
+    player.chain = None
+    return ready
+
+async def make_audio_source(track: Track, guild_id: Optional[int] = None) -> discord.AudioSource:
+    """
+    Источник сразу в Opus: кодирует (или просто перепаковывает Opus) сам FFmpeg,
+    и discord.py не гоняет libopus по каждому 20-мс кадру в Python.
+    """
+    if track.filepath and track.source_msg_id is not None and not os.path.exists(track.filepath):
+        track.filepath = None   # файл выселили из кэша (другой процесс), пока трек ждал очереди
+    if track.filepath is None and track.source_msg_id is not None:
+        await prepare_tg_track(track)
+    if track.page_url:
+        # Прямые ссылки YouTube живут несколько часов — берём свежую прямо перед игрой
+        resolved = await resolve_youtube(track.page_url)
+        track.stream_url, track.codec = resolved.url, resolved.codec
 
     reconnect_opts = "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5"
+    seek = f"-ss {track.start_at:.2f} " if track.start_at else ""
+
+    with metrics.timer("ffmpeg_spawn", guild_id):
+        if track.filepath:
+            return discord.FFmpegOpusAudio(
+                track.filepath,
+                codec=await audio_cache.codec_of(track.filepath),
+                bitrate=OPUS_BITRATE,
+                before_options=f'{seek}-nostdin',
+                options='-vn'
+            )
+        if track.download:
+            # Файл ещё качается: FFmpeg читает его через stdin по мере загрузки
+            return discord.FFmpegOpusAudio(
+                track.download.open_reader(),
+                pipe=True,
+                bitrate=OPUS_BITRATE,
+                before_options=seek.strip() or None,
+                options='-vn'
+            )
+        if track.stream_url:
+            return discord.FFmpegOpusAudio(
+                track.stream_url,
+                codec=track.codec,
+                bitrate=OPUS_BITRATE,
+                before_options=f"{seek}-nostdin {reconnect_opts}",
+                options='-vn'
+            )
+        raise RuntimeError("у трека нет источника (filepath/stream_url)")
 
-    if track.filepath:
-        source = discord.FFmpegPCMAudio(
-            track.filepath,
-            before_options='-nostdin',
-            options='-vn'
-        )
-    elif track.stream_url:
-        source = discord.FFmpegPCMAudio(
-            track.stream_url,
-            before_options=f"-nostdin {reconnect_opts}",
-            options='-vn'
-        )
-    else:
-        print(f"[play_next] у трека '{track.title}' нет источника (filepath/stream_url)")
-        fut = asyncio.run_coroutine_threadsafe(play_next(guild), bot.loop)
-        try:
-            fut.result()
-        except Exception as ee:
-            print("[play_next] ошибка при планировании следующего:", ee)
-        return
+# ────────────────────────────────────────────────────────────────────────────
+# Простой: пауза, выход из канала, выселение
+# ────────────────────────────────────────────────────────────────────────────
 
-    vc.play(source, after=after_play)
+def idle_reason(player: GuildPlayer) -> Optional[str]:
+    """None, если гильдия при деле; иначе почему она простаивает."""
+    vc = player.voice
+    if not vc or not vc.is_connected():
+        return "disconnected"
+    if not channel_has_listeners(vc):
+        return "alone"
+    if player.state is PlayerState.IDLE and not player.queue:
+        return "silent"
+    return None   # /pause при слушателях — не простой
+
+def touch_idle(player: GuildPlayer):
+    """
+    Пересчитывает простой гильдии. Зовётся на каждое изменение голосовых
+    состояний и после каждого шага player_loop; таймер перезапускается,
+    только если причина простоя сменилась.
+    """
+    if players.get(player.guild_id) is not player:
+        return
+    reason = idle_reason(player)
+    if reason == player.idle_reason and (reason is None or player.idle_task is not None):
+        return
+    if player.idle_task is not None:
+        player.idle_task.cancel()
+        player.idle_task = None
+    player.idle_reason = reason
+    if reason is None:
+        vc = player.voice
+        if player.auto_paused and vc and vc.is_paused():
+            vc.resume()
+            player.state = PlayerState.PLAYING
+            print(f"[idle] {player.guild_id}: слушатели вернулись — продолжаю")
+        player.auto_paused = False
+        return
+    player.idle_task = asyncio.create_task(_reap_idle(player, reason), name=f"idle-{player.guild_id}")
+
+async def _reap_idle(player: GuildPlayer, reason: str):
+    waited = 0
+    if reason == "alone":
+        await asyncio.sleep(IDLE_PAUSE_AFTER)
+        waited = IDLE_PAUSE_AFTER
+        vc = player.voice
+        if vc and vc.is_playing():
+            vc.pause()
+            player.state = PlayerState.PAUSED
+            player.auto_paused = True
+            print(f"[idle] {player.guild_id}: в канале никого — пауза")
+    if reason != "disconnected":
+        await asyncio.sleep(max(0, IDLE_DISCONNECT_AFTER - waited))
+        print(f"[idle] {player.guild_id}: простой {IDLE_DISCONNECT_AFTER} с — выхожу из канала")
+        await leave_voice(player)
+    await asyncio.sleep(IDLE_EVICT_AFTER)
+    evict_player(player.guild_id)
+
+async def leave_voice(player: GuildPlayer):
+    """
+    Отключается от голосового канала. Недоигранный трек возвращается в начало
+    очереди с текущей позиции — /play или /join продолжат с того же места.
+    """
+    drop_preload(player)
+    if player.now_playing is not None:
+        position = player.chain.position if player.chain else 0.0
+        player.queue.appendleft(replace(player.now_playing, download=None, start_at=position))
+        player.now_playing = None
+    player.loop_current = False
+    player.auto_paused = False
+    player.idle_reason = "disconnected"   # наш же on_voice_state_update не должен перезапускать таймер
+    vc = player.voice
+    if vc and vc.is_connected():
+        await vc.disconnect(force=True)
+    player.state = PlayerState.IDLE
+
+def evict_player(guild_id: int):
+    """Удаляет плеер гильдии целиком: задачи, загрузки, очередь, голос и метрики."""
+    player = players.pop(guild_id, None)
+    if player is None:
+        return
+    player.queue_epoch += 1   # фоновые /shuffleall в этот плеер больше не пишут
+    if player.idle_task is not None and player.idle_task is not asyncio.current_task():
+        player.idle_task.cancel()
+    if player.task is not None:
+        player.task.cancel()
+    for task in player.prefetch.values():
+        task.cancel()
+    player.prefetch.clear()
+    drop_preload(player)
+    player.queue.clear()
+    player.now_playing = None
+    vc = player.voice
+    if vc and vc.is_connected():
+        asyncio.create_task(vc.disconnect(force=True))
+    player.voice = None
+    metrics.forget_guild(guild_id)
+    print(f"[idle] {guild_id}: плеер удалён")
 
 # ────────────────────────────────────────────────────────────────────────────
 # СЛЭШ-КОМАНДЫ
@@ -271,28 +2096,31 @@ async def _cmd_play(interaction: discord.Interaction, query: str):
     await connect_to_author_channel(interaction)
     player = await ensure_player(interaction.guild)
     async with player.play_lock:
-        found = await search_telegram_audios(query, limit=1)
+        with metrics.timer("catalog_lookup", interaction.guild_id):
+            found = await search_telegram_audios(query, limit=1)
         if not found:
             await interaction.followup.send("Не нашёл подходящих аудио в канале Telegram 🤷‍♂️")
             return
-        msg, title = found[0]
-        path = await download_audio(msg, title)
-        track = Track(title=title, filepath=path, source_msg_id=msg.id)
+        entry = found[0]
+        # Не качаем здесь: play_next начнёт играть, как только придут первые байты
+        track = Track(title=entry.title, filepath=audio_cache.lookup(entry.document_id),
+                      source_msg_id=entry.msg_id)
         player.queue.append(track)
     await interaction.followup.send(f"Добавлено в очередь: **{track.title}**")
     await play_next(interaction.guild)
 
 async def _cmd_latest(interaction: discord.Interaction, n: Optional[int] = 10):
     await interaction.response.defer(thinking=True)
-    results = await search_telegram_audios(None, limit=n or 10)
+    with metrics.timer("catalog_lookup", interaction.guild_id):
+        results = await search_telegram_audios(None, limit=n or 10)
     if not results:
         await interaction.followup.send("В канале не найдено аудио")
         return
     lines = []
-    for msg, title in results:
-        ext = os.path.splitext(msg.file.name or "")[1] if msg.file else ""
-        size_mb = (msg.file.size or 0) / (1024*1024) if msg.file else 0
-        lines.append(f"• **{title}** {ext} — {size_mb:.1f} MB (id: `{msg.id}`)")
+    for entry in results:
+        ext = os.path.splitext(entry.file_name)[1]
+        size_mb = (entry.size or 0) / (1024*1024)
+        lines.append(f"• **{entry.title}** {ext} — {size_mb:.1f} MB (id: `{entry.msg_id}`)")
     await interaction.followup.send("Последние аудио:\n" + "\n".join(lines))
 
 async def _cmd_queue(interaction: discord.Interaction):
@@ -310,8 +2138,14 @@ async def _cmd_queue(interaction: discord.Interaction):
 async def _cmd_skip(interaction: discord.Interaction):
     player = await ensure_player(interaction.guild)
     if player.voice and player.voice.is_playing():
+        if metrics.enabled:
+            player.audio_gap_from = time.perf_counter()   # пауза после skip — тоже track_gap
         player.voice.stop()
         await interaction.response.send_message("⏭️ Пропустил")
+    elif player.state is PlayerState.RESOLVING:
+        # Трек ещё готовится — player_loop увидит это и возьмёт следующий
+        player.now_playing = None
+        await interaction.response.send_message("⏭️ Пропустил")
     else:
         await interaction.response.send_message("Сейчас ничего не играет")
 
@@ -319,6 +2153,7 @@ async def _cmd_pause(interaction: discord.Interaction):
     player = await ensure_player(interaction.guild)
     if player.voice and player.voice.is_playing():
         player.voice.pause()
+        player.state = PlayerState.PAUSED
         await interaction.response.send_message("⏸️ Пауза")
     else:
         await interaction.response.send_message("Нечего ставить на паузу")
@@ -327,6 +2162,8 @@ async def _cmd_resume(interaction: discord.Interaction):
     player = await ensure_player(interaction.guild)
     if player.voice and player.voice.is_paused():
         player.voice.resume()
+        player.state = PlayerState.PLAYING
+        player.auto_paused = False
         await interaction.response.send_message("▶️ Продолжаю")
     else:
         await interaction.response.send_message("Нечего продолжать")
@@ -334,6 +2171,9 @@ async def _cmd_resume(interaction: discord.Interaction):
 async def _cmd_stop(interaction: discord.Interaction):
     player = await ensure_player(interaction.guild)
     player.queue.clear()
+    player.queue_epoch += 1
+    player.now_playing = None
+    refresh_prefetch(player)
     if player.voice and (player.voice.is_playing() or player.voice.is_paused()):
         player.voice.stop()
     await interaction.response.send_message("⏹️ Остановил и очистил очередь")
@@ -341,27 +2181,63 @@ async def _cmd_stop(interaction: discord.Interaction):
 async def _cmd_loop(interaction: discord.Interaction):
     player = await ensure_player(interaction.guild)
     player.loop_current = not player.loop_current
+    refresh_preload(player)   # следующим теперь играет другой трек
     await interaction.response.send_message(
         f"🔁 Зацикливание текущего трека: **{'включено' if player.loop_current else 'выключено'}**"
     )
 
+def is_youtube_playlist(url: str) -> bool:
+    """
+    Плейлист — только /playlist?list=… или list= без конкретного видео.
+    Видео, открытое из плейлиста (watch?v=…&list=…, youtu.be/…?list=…), играет
+    одно, а RD… — автоматические миксы, их вообще не разворачиваем.
+    """
+    parts = urlsplit(url if "://" in url else "https://" + url)
+    params = parse_qs(parts.query)
+    list_id = params.get("list", [""])[0]
+    if not list_id or list_id.startswith("RD"):
+        return False
+    if parts.path.rstrip("/") == "/playlist":
+        return True
+    return "v" not in params and not parts.netloc.lower().endswith("youtu.be")
+
 async def _cmd_yt(interaction: discord.Interaction, query: str):
     await interaction.response.defer(thinking=True)
     await connect_to_author_channel(interaction)
     player = await ensure_player(interaction.guild)
+    if YOUTUBE_URL_RE.match(query.strip()) and is_youtube_playlist(query.strip()):
+        await _enqueue_yt_playlist(interaction, player, query.strip())
+        return
+    try:
+        resolved = await resolve_youtube(query)
+    except Exception as e:
+        await interaction.followup.send(f"❌ Ошибка YouTube: {e}")
+        return
+    async with player.play_lock:
+        player.queue.append(Track(title=resolved.title, stream_url=resolved.url,
+                                  page_url=resolved.page_url, codec=resolved.codec))
+    await interaction.followup.send(f"Добавлено из YouTube: **{resolved.title}**")
+    await play_next(interaction.guild)
+
+async def _enqueue_yt_playlist(interaction: discord.Interaction, player: GuildPlayer, url: str):
+    """Ставит в очередь заглушки по плоскому списку; прямые URL — перед игрой каждого."""
     try:
-        title, direct_url = await asyncio.get_event_loop().run_in_executor(None, ytdlp_resolve, query)
+        title, entries = await run_ytdlp(ytdlp_playlist, url)
     except Exception as e:
         await interaction.followup.send(f"❌ Ошибка YouTube: {e}")
         return
+    if not entries:
+        await interaction.followup.send("В плейлисте не нашлось видео")
+        return
     async with player.play_lock:
-        player.queue.append(Track(title=title, stream_url=direct_url))
-    await interaction.followup.send(f"Добавлено из YouTube: **{title}**")
+        player.queue.extend(Track(title=t, page_url=u) for t, u in entries)
+    await interaction.followup.send(f"Добавлено из плейлиста **{title}**: {len(entries)} трек(ов)")
     await play_next(interaction.guild)
 
 async def _cmd_shuffle_all(interaction: discord.Interaction, limit: Optional[int] = None):
     """
     Собирает ВСЕ (или до limit) аудио из TG, перемешивает, ставит в очередь.
+    Играть начинает после первой пачки, остальные подмешиваются на ходу.
     Скачивание — непосредственно перед проигрыванием.
     """
     await interaction.response.defer(thinking=True)
@@ -369,21 +2245,37 @@ async def _cmd_shuffle_all(interaction: discord.Interaction, limit: Optional[int
     player = await ensure_player(interaction.guild)
 
     max_items = limit or 100
-    all_tracks = await collect_all_tg_audios(max_items=max_items)
-    if not all_tracks:
+    epoch = player.queue_epoch
+    owned: dict[int, Track] = {}   # id -> трек этого перемешивания (ссылка держит id уникальным)
+    added = first = 0
+    reply = None
+    async for batch in iter_shuffled_tg_audio(max_items):
+        if player.queue_epoch != epoch:
+            break   # очередь остановили, пока мы собирали
+        async with player.play_lock:
+            merge_shuffled(player, owned, [Track(title=t, source_msg_id=i) for i, t in batch])
+        added += len(batch)
+        if reply is None:
+            first = added
+            reply = await interaction.followup.send(
+                f"Перемешал и добавил в очередь {added} трек(ов). Поехали! 🔀", wait=True)
+            await play_next(interaction.guild)
+        else:
+            refresh_prefetch(player)
+
+    if reply is None:
         await interaction.followup.send("В канале не найдено ни одного аудио.")
-        return
-
-    random.shuffle(all_tracks)
-
-    added = 0
-    async with player.play_lock:
-        for msg, title in all_tracks:
-            player.queue.append(Track(title=title, source_msg_id=msg.id))
-            added += 1
+    elif added != first:
+        await reply.edit(content=f"Перемешал и добавил в очередь {added} трек(ов). Поехали! 🔀")
 
-    await interaction.followup.send(f"Перемешал и добавил в очередь {added} трек(ов). Поехали! 🔀")
-    await play_next(interaction.guild)
+async def _cmd_stats(interaction: discord.Interaction):
+    if not metrics.enabled:
+        await interaction.response.send_message("Метрики выключены (METRICS=1 в .env)", ephemeral=True)
+        return
+    parts = ["**Все гильдии**"] + (metrics.summary(None) or ["пока нет замеров"])
+    parts += ["**Этот сервер**"] + (metrics.summary(interaction.guild_id) or ["пока нет замеров"])
+    parts.append(f"Запросов к Telegram: {tg_gate.calls}, плееров: {len(players)}")
+    await interaction.response.send_message("\n".join(parts)[:2000], ephemeral=True)
 
 # ────────────────────────────────────────────────────────────────────────────
 # Регистрация слэш-команд
@@ -393,9 +2285,19 @@ async def _cmd_shuffle_all(interaction: discord.Interaction, limit: Optional[int
 async def join_cmd(interaction: discord.Interaction): await _cmd_join(interaction)
 
 @tree.command(name="play", description="Воспроизвести трек из Telegram по запросу")
-@app_commands.describe(query="Название/фраза для поиска")
+@app_commands.describe(query="Название/фраза для поиска или id:<номер сообщения>")
 async def play_cmd(interaction: discord.Interaction, query: str): await _cmd_play(interaction, query)
 
+@play_cmd.autocomplete("query")
+async def play_query_autocomplete(interaction: discord.Interaction, current: str):
+    # Только локальный индекс: ответ должен уложиться в 3 секунды Discord
+    catalog.refresh()
+    if current.strip():
+        found = catalog.index.search(current, 25)
+    else:
+        found = [(e.msg_id, e.title) for e in catalog.latest(25)]
+    return [app_commands.Choice(name=title[:100], value=f"id:{msg_id}") for msg_id, title in found]
+
 @tree.command(name="latest", description="Показать последние N треков из Telegram-канала")
 @app_commands.describe(n="Сколько показать (по умолчанию 10)")
 async def latest_cmd(interaction: discord.Interaction, n: Optional[int] = 10): await _cmd_latest(interaction, n)
@@ -418,8 +2320,8 @@ async def stop_cmd(interaction: discord.Interaction): await _cmd_stop(interactio
 @tree.command(name="loop", description="Вкл/выкл зацикливание текущего трека")
 async def loop_cmd(interaction: discord.Interaction): await _cmd_loop(interaction)
 
-@tree.command(name="yt", description="Воспроизвести звук с YouTube (по ссылке или поиску)")
-@app_commands.describe(query="Ссылка на YouTube или запрос для поиска")
+@tree.command(name="yt", description="Воспроизвести звук с YouTube (по ссылке, плейлисту или поиску)")
+@app_commands.describe(query="Ссылка на видео/плейлист YouTube или запрос для поиска")
 async def yt_cmd(interaction: discord.Interaction, query: str): await _cmd_yt(interaction, query)
 
 @tree.command(name="shuffleall", description="Перемешать и добавить все треки из TG-канала")
@@ -427,29 +2329,451 @@ async def yt_cmd(interaction: discord.Interaction, query: str): await _cmd_yt(in
 async def shuffleall_cmd(interaction: discord.Interaction, limit: Optional[int] = None):
     await _cmd_shuffle_all(interaction, limit)
 
+@tree.command(name="stats", description="Задержки по этапам (для администраторов)")
+@app_commands.default_permissions(administrator=True)
+async def stats_cmd(interaction: discord.Interaction): await _cmd_stats(interaction)
+
+# ────────────────────────────────────────────────────────────────────────────
+# Тёплый рестарт
+# ────────────────────────────────────────────────────────────────────────────
+
+player_state_path = PLAYER_STATE_PATH   # у воркера шардов — свой файл
+_shutting_down = False
+_started = False                        # on_ready приходит и на каждое переподключение
+
+def _track_ref(track: Track) -> Optional[list]:
+    """Компактная ссылка на трек: файл и прямой URL всё равно берутся заново."""
+    if track.source_msg_id is None and not track.page_url:
+        return None
+    return [track.title, track.source_msg_id, track.page_url]
+
+def snapshot_players() -> dict:
+    guilds = {}
+    for guild_id, player in players.items():
+        vc = player.voice
+        if not vc or not vc.is_connected() or (player.now_playing is None and not player.queue):
+            continue
+        state = {
+            "channel_id": vc.channel.id,
+            "loop": player.loop_current,
+            "queue": [ref for ref in map(_track_ref, player.queue) if ref],
+        }
+        if player.now_playing and _track_ref(player.now_playing):
+            state["now_playing"] = _track_ref(player.now_playing)
+            state["position"] = round(player.chain.position, 2) if player.chain else 0.0
+        guilds[str(guild_id)] = state
+    return guilds
+
+_last_snapshot: Optional[dict] = None
+
+def save_player_state():
+    global _last_snapshot
+    guilds = snapshot_players()
+    if guilds == _last_snapshot and os.path.exists(player_state_path):
+        return
+    tmp = player_state_path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"saved_at": time.time(), "guilds": guilds}, f, ensure_ascii=False)
+    os.replace(tmp, player_state_path)
+    _last_snapshot = guilds
+
+async def _player_state_loop():
+    while not _shutting_down:
+        await asyncio.sleep(PLAYER_STATE_INTERVAL)
+        if not _shutting_down:
+            try:
+                save_player_state()
+            except OSError as e:
+                print(f"[restore] не удалось сохранить очереди: {e}")
+
+async def restore_players():
+    """Возвращает гильдии в те каналы и к тем трекам, где их застал рестарт."""
+    root = os.path.dirname(PLAYER_STATE_PATH) or "."
+    prefix = os.path.splitext(os.path.basename(PLAYER_STATE_PATH))[0]
+    for name in sorted(os.listdir(root)):
+        # players.json и players.<N>.json воркеров: шарды могли перераспределиться
+        if not (name.startswith(prefix) and name.endswith(".json")):
+            continue
+        try:
+            with open(os.path.join(root, name), "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if time.time() - data.get("saved_at", 0) > PLAYER_STATE_MAX_AGE:
+            continue
+        for guild_id, state in data.get("guilds", {}).items():
+            guild = bot.get_guild(int(guild_id))
+            if guild is None or guild.id in players:
+                continue
+            channel = guild.get_channel(state["channel_id"])
+            if channel is None or not any(not m.bot for m in channel.members):
+                continue   # слушателей нет — нечего и начинать
+            try:
+                vc = await channel.connect(self_deaf=True)
+            except Exception as e:
+                print(f"[restore] {guild.name}: не удалось зайти в канал: {e}")
+                continue
+            player = await ensure_player(guild)
+            player.voice = vc
+            player.loop_current = state.get("loop", False)
+            position = 0.0
+            if state.get("now_playing"):
+                title, msg_id, page_url = state["now_playing"]
+                position = state.get("position", 0.0)
+                player.queue.append(Track(title=title, source_msg_id=msg_id, page_url=page_url,
+                                          start_at=position))
+            for title, msg_id, page_url in state.get("queue", []):
+                player.queue.append(Track(title=title, source_msg_id=msg_id, page_url=page_url))
+            print(f"[restore] {guild.name}: {len(player.queue)} трек(ов), "
+                  f"продолжаю с {int(position) // 60}:{int(position) % 60:02d}")
+            await play_next(guild)
+
+def _commands_hash() -> str:
+    schema = sorted((c.to_dict(tree) for c in tree.get_commands()), key=lambda d: d["name"])
+    payload = json.dumps({"app": bot.application_id, "commands": schema}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+async def sync_commands_if_changed():
+    """tree.sync медленный и под лимитами — делаем его, только если команды правда поменялись."""
+    digest = _commands_hash()
+    try:
+        with open(COMMANDS_HASH_PATH, "r", encoding="utf-8") as f:
+            if f.read().strip() == digest:
+                print("Слэш-команды не менялись — синхронизация пропущена")
+                return
+    except FileNotFoundError:
+        pass
+    await tree.sync()
+    with open(COMMANDS_HASH_PATH, "w", encoding="utf-8") as f:
+        f.write(digest)
+    print(f"Синхронизированы слэш-команды для {bot.user}")
+
+async def shutdown():
+    """SIGTERM/SIGINT: снимок очередей до того, как bot.close() отключит голос."""
+    global _shutting_down
+    if _shutting_down:
+        return
+    _shutting_down = True
+    try:
+        save_player_state()
+    except OSError as e:
+        print(f"[restore] не удалось сохранить очереди: {e}")
+    audio_cache.flush()
+    await bot.close()
+
+# ────────────────────────────────────────────────────────────────────────────
+# Шарды: координатор и воркеры
+# ────────────────────────────────────────────────────────────────────────────
+#
+# SHARD_WORKERS > 0: этот процесс становится координатором — держит
+# единственную сессию Telethon, пишет каталог и кэш, качает файлы.
+# Воркеры (fork) поднимают AutoShardedBot со своими шардами, играют звук
+# и ходят к координатору через unix-сокет (JSON построчно). Каталог они
+# читают из той же SQLite, кэш — по индексу, который пишет только координатор.
+
+async def _rpc_send(writer: asyncio.StreamWriter, message: dict):
+    writer.write(json.dumps(message).encode() + b"\n")
+    await writer.drain()
+
+async def _rpc_read(reader: asyncio.StreamReader) -> dict:
+    line = await reader.readline()
+    return json.loads(line) if line else {"error": "координатор закрыл соединение"}
+
+async def _rpc_connect() -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    for attempt in range(50):
+        try:
+            return await asyncio.open_unix_connection(COORDINATOR_SOCKET)
+        except (FileNotFoundError, ConnectionRefusedError):
+            if attempt == 49:
+                raise
+            await asyncio.sleep(0.2)   # координатор ещё поднимает сокет
+
+async def coordinator_call(request: dict) -> dict:
+    """Один запрос — один ответ."""
+    reader, writer = await _rpc_connect()
+    try:
+        await _rpc_send(writer, request)
+        reply = await _rpc_read(reader)
+    finally:
+        writer.close()
+    if "error" in reply:
+        raise RuntimeError(reply["error"])
+    return reply
+
+async def _serve_shard(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request = json.loads(await reader.readline() or b"{}")
+        if request.get("op") == "ensure_catalog":
+            await ensure_catalog()
+            await _rpc_send(writer, {"ok": True})
+        elif request.get("op") == "download":
+            await _serve_download(int(request["msg_id"]), reader, writer)
+        elif request.get("op") == "pin":
+            _shard_pins[int(request["worker"])] = (time.monotonic(), set(request["paths"]))
+            for path in request["touched"]:
+                entry = audio_cache._entry_by_path(path)
+                if entry is not None:
+                    audio_cache.touch(entry)
+            await _rpc_send(writer, {"ok": True})
+        else:
+            await _rpc_send(writer, {"error": f"неизвестный запрос: {request!r}"})
+    except ConnectionError:
+        pass
+    except Exception as e:
+        try:
+            await _rpc_send(writer, {"error": str(e) or repr(e)})
+        except ConnectionError:
+            pass
+    finally:
+        writer.close()
+
+async def _serve_download(msg_id: int, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """
+    Качает документ для воркера и шлёт ему, сколько байт .part-файла уже
+    на диске. Закрытое воркером соединение — он больше не ждёт (skip/stop).
+    """
+    cached, dl = await open_tg_download(msg_id)
+    if cached:
+        await _rpc_send(writer, {"path": cached})
+        return
+    dl.acquire()
+    gone = asyncio.create_task(reader.read(1))
+    try:
+        await _rpc_send(writer, {"part_path": os.path.abspath(dl.part_path), "size": dl.size, "ext": dl.ext})
+        sent = 0
+        while not dl.finished:
+            if dl.written != sent:
+                sent = dl.written
+                await _rpc_send(writer, {"written": sent})
+            dl._progress.clear()
+            progress = asyncio.create_task(dl._progress.wait())
+            await asyncio.wait({progress, gone}, return_when=asyncio.FIRST_COMPLETED)
+            progress.cancel()
+            if gone.done():
+                return
+        path = await dl.wait()
+        await _rpc_send(writer, {"written": dl.written, "path": path})
+    finally:
+        gone.cancel()
+        dl.release()
+
+_remote_downloads: dict[int, "RemoteDownload"] = {}   # msg_id -> загрузка через координатора
+_shard_pins: dict[int, tuple[float, set[str]]] = {}   # воркер -> (когда сообщил, его файлы в деле)
+
+async def _report_cache_use(index: int):
+    """
+    Воркер: раз в SHARD_PIN_INTERVAL (и сразу после попадания в кэш) шлёт
+    координатору свои играющие/стоящие в очереди файлы и попадания в кэш —
+    чтобы тот их не выселял и вёл LRU по настоящим воспроизведениям.
+    """
+    while True:
+        try:
+            await asyncio.wait_for(audio_cache.touched_event.wait(), timeout=SHARD_PIN_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        audio_cache.touched_event.clear()
+        touched, audio_cache.touched = audio_cache.touched, set()
+        try:
+            await coordinator_call({"op": "pin", "worker": index,
+                                    "paths": sorted(paths_in_use()), "touched": sorted(touched)})
+        except Exception as e:
+            audio_cache.touched |= touched
+            print(f"[shards] не удалось сообщить координатору о файлах в деле: {e}")
+
+class RemoteDownload(TgDownload):
+    """
+    Загрузка, которую на самом деле ведёт координатор. Интерфейс тот же, что
+    у TgDownload, а .part-файл читается через /proc/self/fd: координатор
+    может переложить его в кэш, пока FFmpeg воркера ещё не дочитал.
+    """
+
+    def __init__(self, msg_id: int):
+        self._init_state(None, None, 0, "", "")   # размер и .part сообщит координатор
+        self.msg_id = msg_id
+        self.ready = asyncio.Event()   # пришёл первый ответ: путь из кэша или начало загрузки
+        self._fd: Optional[int] = None
+        _remote_downloads[msg_id] = self
+        self.task = asyncio.create_task(self._run())
+
+    async def _run(self) -> str:
+        writer = None
+        try:
+            reader, writer = await _rpc_connect()
+            await _rpc_send(writer, {"op": "download", "msg_id": self.msg_id})
+            while True:
+                reply = await _rpc_read(reader)
+                if "error" in reply:
+                    raise RuntimeError(reply["error"])
+                if "part_path" in reply:
+                    self.size, self.ext = reply["size"], reply["ext"]
+                    part_path = reply["part_path"]
+                    self.ready.set()
+                if "path" in reply:
+                    # Файл уже в кэше (.part переехал) — читатели откроют его по пути
+                    self.path = reply["path"]
+                    self._set_written(reply.get("written", self.written))
+                    self._finish(failed=False)
+                    return self.path
+                if reply.get("written") and self._fd is None:
+                    try:
+                        self._fd = os.open(part_path, os.O_RDONLY)
+                    except FileNotFoundError:
+                        continue   # координатор успел переложить его в кэш — путь придёт следующим ответом
+                    self.part_path = f"/proc/self/fd/{self._fd}"
+                if "written" in reply:
+                    self._set_written(reply["written"])
+        except BaseException:
+            self._finish(failed=True)
+            raise
+        finally:
+            self.ready.set()
+            if writer is not None:
+                writer.close()
+            if self._fd is not None:
+                os.close(self._fd)
+            if _remote_downloads.get(self.msg_id) is self:
+                del _remote_downloads[self.msg_id]
+
+async def open_remote_download(msg_id: int) -> tuple[Optional[str], Optional[RemoteDownload]]:
+    """То же, что open_tg_download, но через координатора."""
+    dl = _remote_downloads.get(msg_id)
+    if dl is None or dl.failed or dl.abandoned:
+        dl = RemoteDownload(msg_id)
+    await dl.ready.wait()
+    if dl.path:
+        return dl.path, None
+    if dl.failed:
+        await dl.wait()   # поднимет ошибку координатора
+    return None, dl
+
+def _run_shard_worker(index: int, shard_ids: list[int]):
+    global process_role, catalog, METRICS_PORT, player_state_path
+    process_role = "worker"
+    player_state_path = os.path.splitext(PLAYER_STATE_PATH)[0] + f".{index}.json"
+    # SQLite-соединение родителя после fork использовать нельзя
+    catalog = TrackCatalog(CATALOG_PATH, (TELEGRAM_CHANNEL or "").strip())
+    audio_cache.readonly = True
+    if METRICS_PORT:
+        METRICS_PORT += index + 1
+    bot.shard_ids = shard_ids
+    start_ytdlp_pool()
+
+    async def run():
+        await start_metrics_server()
+        asyncio.create_task(_report_cache_use(index))
+        await main()
+    print(f"[shards] воркер {index}: шарды {shard_ids} из {SHARD_COUNT}")
+    asyncio.run(run())
+
+async def _run_coordinator(workers: list) -> bool:
+    """Работает, пока живы все воркеры; False — если кто-то из них упал."""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    await tele_client.connect()
+    if os.path.exists(COORDINATOR_SOCKET):
+        os.remove(COORDINATOR_SOCKET)
+    server = await asyncio.start_unix_server(_serve_shard, path=COORDINATOR_SOCKET)
+    await start_metrics_server()
+    asyncio.create_task(ensure_catalog())
+    asyncio.create_task(audio_cache.adopt_orphans())
+    print(f"[shards] координатор: воркеров {len(workers)}, шардов {SHARD_COUNT}")
+    async with server:
+        while not stop.is_set() and all(p.is_alive() for p in workers):
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=1)
+            except asyncio.TimeoutError:
+                pass
+    audio_cache.flush()
+    if stop.is_set():
+        return True   # воркеры получат SIGTERM и сами сохранят очереди
+    dead = ", ".join(p.name for p in workers if not p.is_alive())
+    print(f"[shards] завершился {dead} — останавливаю остальные")
+    return False
+
+def run_sharded():
+    """
+    Воркеры форкаются до того, как в этом процессе появятся event loop,
+    потоки и соединения Telethon. Упал один воркер — выходим целиком,
+    перезапуск за systemd.
+    """
+    global process_role
+    ctx = multiprocessing.get_context("fork")
+    workers = []
+    for i in range(SHARD_WORKERS):
+        shard_ids = list(range(i, SHARD_COUNT, SHARD_WORKERS))
+        p = ctx.Process(target=_run_shard_worker, args=(i, shard_ids), name=f"shard-worker-{i}")
+        p.start()
+        workers.append(p)
+    process_role = "coordinator"
+    clean = False
+    try:
+        clean = asyncio.run(_run_coordinator(workers))
+    finally:
+        for p in workers:
+            if p.is_alive():
+                p.terminate()
+        for p in workers:
+            p.join(timeout=10)
+        try:
+            if tele_client.is_connected():
+                asyncio.run(tele_client.disconnect())
+        except RuntimeError:
+            pass
+    if not clean:
+        raise SystemExit(1)
+
 # ────────────────────────────────────────────────────────────────────────────
 # Запуск
 # ────────────────────────────────────────────────────────────────────────────
 
 @bot.event
 async def on_ready():
-    if not tele_client.is_connected():
-        await tele_client.connect()
+    global _started
+    if _started:
+        print(f"Переподключился: {bot.user}")
+        return
+    _started = True
+    asyncio.create_task(ensure_catalog())
+    if process_role != "worker":
+        if not tele_client.is_connected():
+            await tele_client.connect()
+        asyncio.create_task(audio_cache.adopt_orphans())
+    # Команды глобальные — у шардов их синхронизирует один воркер
+    if process_role != "worker" or 0 in bot.shard_ids:
+        try:
+            await sync_commands_if_changed()
+        except Exception as e:
+            print("Не удалось синхронизировать команды:", e)
     try:
-        await tree.sync()
-        print(f"Синхронизированы слэш-команды для {bot.user}")
+        await restore_players()
     except Exception as e:
-        print("Не удалось синхронизировать команды:", e)
+        print(f"[restore] не удалось восстановить очереди: {e!r}")
+    asyncio.create_task(_player_state_loop())
     print(f"Готово: {bot.user} (ID: {bot.user.id})")
 
+@bot.event
+async def on_voice_state_update(member: discord.Member, before: discord.VoiceState, after: discord.VoiceState):
+    player = players.get(member.guild.id)
+    if player is not None:
+        touch_idle(player)
+
 async def main():
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, lambda: asyncio.create_task(shutdown()))
     async with bot:
         await bot.start(DISCORD_TOKEN)
 
-if __name__ == "__main__":
+if __name__ == "__main__" and SHARD_WORKERS:
+    run_sharded()
+elif __name__ == "__main__":
     async def run():
         await tele_client.connect()
+        await start_metrics_server()
         await main()
+    start_ytdlp_pool()
     try:
         asyncio.run(run())
     finally:
@@ -0,0 +1,32 @@
+import os
+import sys
+import tempfile
+
+_tmp = tempfile.mkdtemp()
+for key, value in {"DISCORD_TOKEN": "test", "TELEGRAM_API_ID": "1", "TELEGRAM_API_HASH": "test",
+                   "TELEGRAM_CHANNEL": "test", "TEMP_DIR": _tmp,
+                   "TELEGRAM_SESSION_NAME": os.path.join(_tmp, "test")}.items():
+    os.environ.setdefault(key, value)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import TitleIndex, normalize_title
+
+
+def make_index(titles):
+    index = TitleIndex()
+    index.add((i, t, normalize_title(t)) for i, t in enumerate(titles, 1))
+    return index
+
+
+def test_exact_title_wins_among_many_ties():
+    titles = [f"Kino - Gruppa krovi live {n}" for n in range(1, 200)] + ["Кино"]
+    index = make_index(titles)
+    assert index.search("кино", 1) == [(200, "Кино")]
+    assert (200, "Кино") in index.search("кино", 5)
+
+
+def test_dead_docs_do_not_take_candidate_slots():
+    titles = [f"Kino live {n}" for n in range(1, 50)] + ["Кино"]
+    index = make_index(titles)
+    index.remove(range(1, 50))
+    assert index.search("кино", 1) == [(50, "Кино")]